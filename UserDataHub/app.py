@@ -1,26 +1,34 @@
 from tornado import web
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import app_log, access_log, gen_log
 import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import os
+import sys
+import gc
 import logging
 import binascii
-import yaml
 import signal
+import select
 import asyncio
 import time
 from functools import partial
 
-from tornado_sqlalchemy import SQLAlchemy
+from tornado_sqlalchemy import SQLAlchemy, set_max_workers
 
 from traitlets.config import Application, catch_config_error
 
 from traitlets import List, Bool, Integer, Set, Unicode, Dict, Any, default, observe, Instance, Float, validate, Bytes, Type, TraitError, Int
-from .handlers import Template404, HealthCheckHandler, GetUser, GetUsers
+from .handlers import Template404, HealthCheckHandler, MetricsHandler, GetUser, GetUserBatch, GetUsers
 from .users import UserConfigurator, NFSUserConfigurator
+from .provisioner import HomeFolderProvisioner
+from .loader import UserDataLoader
 
 from .utils import url_path_join
-from .orm import db
+from .metrics import CONFIGURATOR_BUILD_DURATION_SECONDS, update_configurator_metrics, mark_process_dead
+from .orm import db, upgrade_db
+from .repository import UserRepository
 
 COOKIE_SECRET_BYTES = (
     32  # the number of bytes to use when generating new cookie secrets
@@ -61,9 +69,33 @@ class UserDataHub(Application):
         config=True
     )
 
-    user_data_file = Unicode('user_data.yaml', help="The user data file to load").tag(
-        config=True
-    )
+    user_data_file = Unicode('user_data.yaml',
+        help="""
+        The user data file to load. This can also be a directory of section
+        files, such as one per course, which are tracked separately so that
+        editing one only reloads the users in that section.
+        """
+    ).tag(config=True)
+
+    user_data_cache_file = Unicode('',
+        help="""
+        File in which to cache the parsed user data files. Files that haven't
+        changed since the cache was written are loaded from the cache instead
+        of parsing the YAML again. The cache is ignored unless it is owned by
+        the user UserDataHub runs as and only that user can write it. Leave
+        empty to always parse the YAML.
+        """
+    ).tag(config=True)
+
+    user_data_reload_interval = Float(0,
+        help="""
+        Time in seconds between checks of user_data_file for changes. When the
+        file changes, it is reloaded without restarting the server. Set to 0 to
+        disable the check. Sending SIGHUP always reloads the file. With
+        several worker processes, only the parent checks the file, and it
+        replaces the workers with ones that have the new user data.
+        """
+    ).tag(config=True)
 
     cookie_secret = Bytes(
         help="""The cookie secret to use to encrypt cookies.
@@ -88,11 +120,75 @@ class UserDataHub(Application):
 
     port = Integer(default_value=8888, help="Port that server will listen on.").tag(config=True)
 
+    num_processes = Integer(1,
+        help="""
+        The number of worker processes to serve requests with. The user data
+        is loaded once before the workers are forked so that they share it.
+        Set to 0 to start one worker per CPU.
+        """
+    ).tag(config=True)
+
     db_url = Unicode(
         'sqlite:///userdatahub.sqlite',
         help="url for the database. e.g. `sqlite:///userdatahub.sqlite`",
     ).tag(config=True)
 
+    db_pool_size = Integer(None, allow_none=True,
+        help="""
+        The number of connections to keep open to the database. Leave unset to
+        use the SQLAlchemy default for the database.
+        """
+    ).tag(config=True)
+
+    db_max_overflow = Integer(None, allow_none=True,
+        help="""
+        The number of connections that can be opened beyond db_pool_size. Leave
+        unset to use the SQLAlchemy default for the database.
+        """
+    ).tag(config=True)
+
+    db_pool_recycle = Integer(None, allow_none=True,
+        help="""
+        Time in seconds after which database connections are replaced. Leave
+        unset to never replace connections.
+        """
+    ).tag(config=True)
+
+    db_pool_pre_ping = Bool(False,
+        help="""
+        Whether or not to check that a database connection is alive before using it.
+        """
+    ).tag(config=True)
+
+    db_max_workers = Integer(None, allow_none=True,
+        help="""
+        The number of threads used to run database queries off of the IOLoop.
+        Defaults to the number of CPUs.
+        """
+    ).tag(config=True)
+
+    persist_user_dict = Bool(False,
+        help="""
+        Whether or not to store the computed user records in the database.
+        When the user data file hasn't changed since they were stored, the
+        records are loaded from the database at startup instead of being
+        built again.
+        """
+    ).tag(config=True)
+
+    max_batch_size = Int(1000,
+        help="""
+        The maximum number of users that can be requested at once from /get-user-batch.
+        """
+    ).tag(config=True)
+
+    users_page_size = Int(1000,
+        help="""
+        The default and maximum number of users returned in one page of
+        /get-all-users when it is paged with the `limit` or `cursor` arguments.
+        """
+    ).tag(config=True)
+
     auth_token_valid_time = Int(300,
         help="""
         Time in seconds that the auth token will be valid.
@@ -147,8 +243,11 @@ class UserDataHub(Application):
         with open(self.config_file, mode='w') as f:
             f.write(config_text)
 
+    # The number of this worker process, or None when running a single process.
+    task_id = None
+
     # This sets the classes so that classes show up in the config file.
-    classes = [UserConfigurator, NFSUserConfigurator]
+    classes = [UserConfigurator, NFSUserConfigurator, HomeFolderProvisioner, UserRepository, UserDataLoader]
 
 
     @catch_config_error
@@ -167,8 +266,10 @@ class UserDataHub(Application):
 
         self.init_logging()
         self.init_db()
+        self.init_repository()
         self.init_secrets()
         self.init_user_database()
+        self.init_provisioner()
         self.init_handlers()
         self.init_tornado_settings()
         self.init_tornado()
@@ -177,23 +278,155 @@ class UserDataHub(Application):
         self.log.info("Initializing handlers.")
         self.handlers = [
                          (r"/get-user", GetUser),
-                        #  (r"/get-all-users", GetUsers),
+                         (r"/get-user-batch", GetUserBatch),
+                         (r"/get-all-users", GetUsers),
                          (r'/health$', HealthCheckHandler),
+                         (r'/metrics$', MetricsHandler),
                          (r'(.*)', Template404)
                          ]
 
     def init_db(self):
         self.log.info("Initializing the database.")
-        db.configure(self.db_url, engine_options={'echo': False})
+        engine_options = {'echo': False, 'pool_pre_ping': self.db_pool_pre_ping}
+        # Only pass the pool settings that were set, since not every pool
+        # (e.g. the default one for SQLite) accepts them.
+        for option in ('pool_size', 'max_overflow', 'pool_recycle'):
+            value = getattr(self, 'db_' + option)
+            if value is not None:
+                engine_options[option] = value
+        db.configure(self.db_url, engine_options=engine_options)
         db.create_all()
+        upgrade_db(db)
+        if self.db_max_workers is not None:
+            set_max_workers(self.db_max_workers)
+
+    def init_repository(self):
+        self.log.info("Initializing the user repository.")
+        self.user_repository = UserRepository(db=db, parent=self, log=self.log)
 
 
     def init_user_database(self):
         self.log.info("Initializing the configurator.")
-        with open(self.user_data_file, 'r') as f:
-            section_dict = yaml.full_load(f)
+        self._reloading = False
+        self.user_data_loader = UserDataLoader(self.user_data_file,
+                                               cache_file=self.user_data_cache_file,
+                                               parent=self,
+                                               log=self.log)
+        self.configurator = self.load_configurator()
+        update_configurator_metrics(self.configurator)
+
+    def get_user_data_mtime(self):
+        return self.user_data_loader.get_signature()
+
+    def load_configurator(self, previous_configurator=None):
+        """
+        Read the user data and build a configurator from it. When reloading,
+        only the files that changed are parsed again, and the previous
+        configurator is used so that only the users in changed sections are
+        rebuilt.
+        """
+        self.user_data_mtime = self.get_user_data_mtime()
+        with CONFIGURATOR_BUILD_DURATION_SECONDS.time():
+            # With several workers, the parent writes the cache for all of them.
+            section_dict, source_hash = self.user_data_loader.load(save_cache=self.task_id is None)
+
+            user_dict_loader = None
+            if self.persist_user_dict:
+                user_dict_loader = self.user_repository.load_user_dict
+
+            configurator = NFSUserConfigurator(section_dict=section_dict,
+                                               previous_configurator=previous_configurator,
+                                               source_hash=source_hash,
+                                               user_dict_loader=user_dict_loader,
+                                               parent=self,
+                                               log=self.log)
+
+        return configurator
+
+    async def save_user_dict(self, configurator):
+        """
+        Store the user records of the configurator in the database in the background.
+        """
+        if not self.persist_user_dict or configurator.loaded_from_cache or configurator.lazy_user_dict:
+            return
+        # With several workers, the first one stores the records for all of them.
+        if self.task_id not in (None, 0):
+            return
+
+        self.log.info("Storing %i user records in the database.", len(configurator.user_dict))
+        try:
+            await self.user_repository.save_user_dict(configurator.cache_key, configurator.user_dict)
+        except Exception:
+            self.log.exception("Failed to store the user records in the database.")
+
+    def set_configurator(self, configurator):
+        """
+        Swap in a new configurator. This must be called from the IOLoop thread
+        so that a request never sees half of a reload.
+        """
+        self.configurator = configurator
+        self.provisioner.configurator = configurator
+        self.tornado_app.settings['configurator'] = configurator
+        update_configurator_metrics(configurator)
+
+    async def reload_user_database(self):
+        """
+        Rebuild the configurator in the background and swap it in once it is
+        ready. Requests are served from the old one in the meantime.
+        """
+        if self._reloading:
+            self.log.info("A reload of %s is already running.", self.user_data_file)
+            return
+
+        self.log.info("Reloading %s.", self.user_data_file)
+        self._reloading = True
+        start = time.perf_counter()
+        try:
+            configurator = await IOLoop.current().run_in_executor(None, self.load_configurator, self.configurator)
+        except Exception:
+            self.log.exception("Failed to reload %s. Keeping the current user data.", self.user_data_file)
+            return
+        finally:
+            self._reloading = False
+
+        self.set_configurator(configurator)
+        self.start_preprovision()
+        self.log.info("Reloaded %s in %.3f seconds.", self.user_data_file, time.perf_counter() - start)
+        await self.save_user_dict(configurator)
 
-        self.configurator = NFSUserConfigurator(section_dict=section_dict, parent=self, log=self.log)
+    def start_preprovision(self):
+        """
+        Create the home folders of all users in the background if that is enabled.
+        """
+        # With several workers, the first one creates the folders for all of them.
+        if self.task_id not in (None, 0):
+            return
+        self.provisioner.start_preprovision()
+
+    async def check_user_data_file(self):
+        """
+        Reload the user data file if it has been modified. For a directory,
+        this stats every file, which can take a while on NFS, so it is done
+        in the executor.
+        """
+        if self._reloading:
+            return
+        mtime = await IOLoop.current().run_in_executor(None, self.get_user_data_mtime)
+        if self._reloading:
+            return
+        if mtime is not None and mtime != self.user_data_mtime:
+            await self.reload_user_database()
+
+    def reload_sig_handler(self, sig, frame):
+        """
+        Reload the user data file when SIGHUP is received.
+        """
+        self.log.info('Caught signal: %s', sig)
+        IOLoop.current().add_callback_from_signal(self.reload_user_database)
+
+    def init_provisioner(self):
+        self.log.info("Initializing the home folder provisioner.")
+        self.provisioner = HomeFolderProvisioner(configurator=self.configurator, db=db, parent=self, log=self.log)
 
     def init_logging(self):
         self.log.info("Initializing loggers.")
@@ -223,8 +456,11 @@ class UserDataHub(Application):
             log=self.log,
             cookie_secret = self.cookie_secret,
             auth_token_valid_time = self.auth_token_valid_time,
+            max_batch_size = self.max_batch_size,
+            users_page_size = self.users_page_size,
             app = self,
             configurator = self.configurator,
+            provisioner = self.provisioner,
             db = db
         )
 
@@ -317,6 +553,8 @@ class UserDataHub(Application):
 
         def shutdown():
             self.log.info(f'Will shutdown in {TORNADO_SHUTDOWN_WAIT} seconds ...')
+            # Pre-provisioning can run for a long time, so don't wait for it.
+            self.provisioner.stop_preprovision()
             try:
                 stop_loop(server, time.time() + TORNADO_SHUTDOWN_WAIT)
             except BaseException as e:
@@ -325,6 +563,158 @@ class UserDataHub(Application):
         logging.warning('Caught signal: %s', sig)
         io_loop.add_callback_from_signal(shutdown)
 
+    def fork_workers(self, num_processes):
+        """
+        Fork the worker processes. This only returns in the workers, with the
+        number of the worker. The parent forwards SIGTERM and SIGINT to the
+        workers so that they shut down gracefully, restarts workers that die
+        unexpectedly, and exits once all of them are done.
+
+        On SIGHUP, or when it notices that the user data changed, the parent
+        reloads the user data once and forks a fresh set of workers from it,
+        so that they keep sharing the user data. The old workers get a SIGTERM
+        and finish their requests in the meantime.
+
+        The signal handlers only take note of the signal. The work is done in
+        the wait loop, so workers that die during a reload are restarted by
+        the reload and never by a signal handler in the middle of something.
+        """
+        children = {}
+        retiring = set()
+        stopping = False
+        reload_requested = False
+
+        # A signal wakes up the select in the wait loop through this pipe.
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+
+        def fork(task_id):
+            # Anything collected after the fork would touch the shared pages of
+            # the user data in every worker, so move it out of the collector's way.
+            gc.collect()
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+            # Connections can't be shared between processes.
+            db.engine.dispose()
+            pid = os.fork()
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.close(wakeup_read)
+                os.close(wakeup_write)
+                return True
+            children[pid] = task_id
+            return False
+
+        for task_id in range(num_processes):
+            if fork(task_id):
+                return task_id
+
+        def forward_signal(sig, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in list(children):
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+
+        def request_reload(sig, frame):
+            nonlocal reload_requested
+            reload_requested = True
+
+        def reload_workers():
+            self.log.info("Reloading %s.", self.user_data_file)
+            start = time.perf_counter()
+            try:
+                configurator = self.load_configurator(self.configurator)
+            except Exception:
+                self.log.exception("Failed to reload %s. Keeping the current user data.", self.user_data_file)
+                return None
+            self.set_configurator(configurator)
+            self.log.info("Reloaded %s in %.3f seconds. Replacing the workers.",
+                          self.user_data_file, time.perf_counter() - start)
+            old_workers = list(children)
+            retiring.update(old_workers)
+            for task_id in range(num_processes):
+                if fork(task_id):
+                    return task_id
+            for pid in old_workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            return None
+
+        def user_data_changed():
+            mtime = self.get_user_data_mtime()
+            return mtime is not None and mtime != self.user_data_mtime
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, forward_signal)
+        signal.signal(signal.SIGHUP, request_reload)
+        signal.signal(signal.SIGCHLD, lambda sig, frame: None)
+        signal.set_wakeup_fd(wakeup_write)
+
+        # Only the parent checks the user data for changes, since a reload in
+        # every worker would throw away the pages they share with each other.
+        interval = self.user_data_reload_interval
+        next_check = None
+        if interval > 0:
+            self.log.info("Checking %s for changes every %s seconds.", self.user_data_file, interval)
+            next_check = time.monotonic() + interval
+
+        self.log.info("Started %i worker processes.", num_processes)
+        while children:
+            timeout = None if next_check is None else max(next_check - time.monotonic(), 0)
+            select.select([wakeup_read], [], [], timeout)
+            try:
+                while os.read(wakeup_read, 512):
+                    pass
+            except BlockingIOError:
+                pass
+
+            while children:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    children.clear()
+                    break
+                if pid == 0:
+                    break
+                task_id = children.pop(pid, None)
+                if task_id is None:
+                    continue
+                mark_process_dead(pid)
+
+                if pid in retiring:
+                    retiring.discard(pid)
+                    self.log.info("Worker %i (pid %i) from before the reload exited.", task_id, pid)
+                elif os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+                    self.log.warning("Worker %i (pid %i) exited with status %i.", task_id, pid, status)
+                    if not stopping:
+                        self.log.info("Restarting worker %i.", task_id)
+                        if fork(task_id):
+                            return task_id
+                else:
+                    self.log.info("Worker %i (pid %i) exited.", task_id, pid)
+
+            if stopping:
+                continue
+            if next_check is not None and time.monotonic() >= next_check:
+                next_check = time.monotonic() + interval
+                if user_data_changed():
+                    reload_requested = True
+            if reload_requested:
+                reload_requested = False
+                task_id = reload_workers()
+                if task_id is not None:
+                    return task_id
+
+        self.log.info("All workers have exited.")
+        sys.exit(0)
+
     def start(self):
 
         self.log.info("Starting the app.")
@@ -332,14 +722,37 @@ class UserDataHub(Application):
             self.write_config_file()
             return
 
-        http_server = tornado.httpserver.HTTPServer(self.tornado_app)
-        http_server.listen(self.port)
+        num_processes = self.num_processes or tornado.process.cpu_count()
+        if num_processes > 1 and _mswindows:
+            self.log.warning("Multiple worker processes aren't supported on Windows. Using one.")
+            num_processes = 1
+
+        if num_processes > 1:
+            # Bind before forking so that all of the workers accept from the same socket.
+            sockets = tornado.netutil.bind_sockets(self.port)
+            self.task_id = self.fork_workers(num_processes)
+            self.log.info("Worker %i (pid %i) is starting.", self.task_id, os.getpid())
+            http_server = tornado.httpserver.HTTPServer(self.tornado_app)
+            http_server.add_sockets(sockets)
+        else:
+            http_server = tornado.httpserver.HTTPServer(self.tornado_app)
+            http_server.listen(self.port)
 
         signal.signal(signal.SIGTERM, partial(self.sig_handler, http_server))
         signal.signal(signal.SIGINT, partial(self.sig_handler, http_server))
+        if not _mswindows:
+            signal.signal(signal.SIGHUP, self.reload_sig_handler)
+
+        # With several workers, the parent checks for changes and replaces them.
+        if self.user_data_reload_interval > 0 and self.task_id is None:
+            self.log.info("Checking %s for changes every %s seconds.", self.user_data_file, self.user_data_reload_interval)
+            PeriodicCallback(self.check_user_data_file, self.user_data_reload_interval * 1000).start()
 
+        IOLoop.current().add_callback(self.save_user_dict, self.configurator)
+        IOLoop.current().add_callback(self.start_preprovision)
 
         IOLoop.instance().start()
+        self.provisioner.shutdown(wait=False)
         self.log.info("Cleanly shut down the server.")
         # except KeyboardInterrupt:
             # IOLoop.instance().stop()
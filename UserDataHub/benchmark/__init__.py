@@ -0,0 +1,3 @@
+from .roster import generate_roster, count_roster, write_roster
+from .bench import benchmark_configurators, benchmark_http, run_load_test
+from .app import UserDataBenchmark, main
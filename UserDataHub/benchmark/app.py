@@ -0,0 +1,201 @@
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from tornado.ioloop import IOLoop
+
+from traitlets.config import Application, catch_config_error
+from traitlets import Bool, Float, Integer, Unicode, default
+
+from .._version import __version__
+from .roster import generate_roster, count_roster, write_roster
+from .bench import benchmark_configurators, benchmark_http
+
+
+class UserDataBenchmark(Application):
+    """
+    Generate a synthetic roster and time UserDataHub against it.
+    """
+
+    name = 'userdatahub-benchmark'
+
+    aliases = {
+        'log_level': 'UserDataBenchmark.log_level',
+        'depth': 'UserDataBenchmark.depth',
+        'sections': 'UserDataBenchmark.sections',
+        'groups': 'UserDataBenchmark.groups',
+        'members': 'UserDataBenchmark.members',
+        'users': 'UserDataBenchmark.users',
+        'users-per-section': 'UserDataBenchmark.users_per_section',
+        'config-size': 'UserDataBenchmark.config_size',
+        'seed': 'UserDataBenchmark.seed',
+        'repeat': 'UserDataBenchmark.repeat',
+        'root': 'UserDataBenchmark.root_path',
+        'output': 'UserDataBenchmark.output_file',
+        'requests': 'UserDataBenchmark.http_requests',
+        'concurrency': 'UserDataBenchmark.http_concurrency',
+        'processes': 'UserDataBenchmark.http_processes',
+    }
+
+    flags = {
+        'no-http': (
+            {'UserDataBenchmark': {'run_http': False}},
+            "skip the HTTP load test",
+        ),
+        'keep': (
+            {'UserDataBenchmark': {'keep_files': True}},
+            "keep the generated roster and folders",
+        ),
+    }
+
+    depth = Integer(2, help="The number of levels of sections.").tag(config=True)
+
+    sections = Integer(4, help="The number of subsections in every section.").tag(config=True)
+
+    groups = Integer(4, help="The number of groups in every section.").tag(config=True)
+
+    members = Integer(25, help="The number of members of every group.").tag(config=True)
+
+    users = Integer(1000, help="The number of users in the roster.").tag(config=True)
+
+    users_per_section = Integer(250,
+        help="""
+        The number of users in every section. Subsections draw their users
+        from their parent section.
+        """
+    ).tag(config=True)
+
+    config_size = Integer(4,
+        help="""
+        The number of environment variables in every configAppend and
+        configOverride blob.
+        """
+    ).tag(config=True)
+
+    admin_fraction = Float(0.01, help="The fraction of section users that are admins.").tag(config=True)
+
+    seed = Integer(0, help="The seed for generating the roster.").tag(config=True)
+
+    repeat = Integer(3, help="The number of times each configurator is built.").tag(config=True)
+
+    root_path = Unicode(
+        help="""
+        The folder to generate the roster and create home folders in. Defaults
+        to a new folder on /dev/shm (a tmpfs) when it exists, so that the
+        results don't depend on the disk. The folder is only removed
+        afterwards if it didn't exist or was empty.
+        """
+    ).tag(config=True)
+
+    @default('root_path')
+    def _root_path_default(self):
+        base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        return tempfile.mkdtemp(prefix='userdatahub-benchmark-', dir=base)
+
+    output_file = Unicode('benchmark_results.json', help="The file to save the results to as JSON.").tag(config=True)
+
+    run_http = Bool(True, help="Whether or not to run the HTTP load test against /get-user.").tag(config=True)
+
+    http_requests = Integer(1000, help="The number of requests in each round of the load test.").tag(config=True)
+
+    http_concurrency = Integer(32, help="The number of requests the load test keeps in flight.").tag(config=True)
+
+    http_processes = Integer(1, help="The number of worker processes the server is started with.").tag(config=True)
+
+    keep_files = Bool(False, help="Whether or not to keep the generated roster and folders.").tag(config=True)
+
+    @catch_config_error
+    def initialize(self, *args, **kwargs):
+        super().initialize(*args, **kwargs)
+
+    def get_parameters(self):
+        return {
+            name: getattr(self, name)
+            for name in ('depth', 'sections', 'groups', 'members', 'users', 'users_per_section',
+                         'config_size', 'admin_fraction', 'seed', 'repeat', 'http_requests',
+                         'http_concurrency', 'http_processes')
+        }
+
+    def run(self):
+        """
+        Run every benchmark and return the results.
+        """
+        results = {
+            'version': __version__,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'parameters': self.get_parameters(),
+        }
+
+        self.log.info("Generating the roster in %s", self.root_path)
+        start = time.perf_counter()
+        section_dict = generate_roster(depth=self.depth,
+                                       sections=self.sections,
+                                       groups=self.groups,
+                                       members=self.members,
+                                       users=self.users,
+                                       users_per_section=self.users_per_section,
+                                       config_size=self.config_size,
+                                       admin_fraction=self.admin_fraction,
+                                       seed=self.seed)
+        user_data_file = os.path.join(self.root_path, 'user_data.yaml')
+        results['roster'] = count_roster(section_dict)
+        results['roster']['bytes'] = write_roster(section_dict, user_data_file)
+        results['roster']['generate'] = time.perf_counter() - start
+        self.log.info("Generated %(users)i users in %(sections)i sections and %(groups)i groups.", results['roster'])
+
+        self.log.info("Timing the configurators.")
+        results['configurators'] = benchmark_configurators(section_dict,
+                                                           os.path.join(self.root_path, 'configurators'),
+                                                           repeat=self.repeat,
+                                                           parent=self)
+
+        if self.run_http:
+            self.log.info("Running the HTTP load test.")
+            server_dir = os.path.join(self.root_path, 'server')
+            os.makedirs(server_dir, exist_ok=True)
+            usernames = sorted({username for section in self.iter_sections(section_dict)
+                                for username in section.get('users', {})})
+            results['http'] = IOLoop.current().run_sync(
+                lambda: benchmark_http(user_data_file,
+                                       os.path.join(server_dir, 'data'),
+                                       server_dir,
+                                       usernames,
+                                       requests=self.http_requests,
+                                       concurrency=self.http_concurrency,
+                                       num_processes=self.http_processes))
+
+        return results
+
+    def iter_sections(self, section_dict):
+        yield section_dict
+        for section in section_dict.get('sections', {}).values():
+            yield from self.iter_sections(section)
+
+    def start(self):
+        # Only remove the folder afterwards if it was made for this run.
+        created_root = not os.path.exists(self.root_path) or not os.listdir(self.root_path)
+        os.makedirs(self.root_path, exist_ok=True)
+        try:
+            results = self.run()
+        finally:
+            if not self.keep_files and created_root:
+                shutil.rmtree(self.root_path, ignore_errors=True)
+
+        with open(self.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        self.log.warning("Saved the results to %s", self.output_file)
+
+def main(argv=None):
+    app = UserDataBenchmark()
+    app.initialize(argv)
+    app.start()
+
+if __name__ == "__main__":
+    main()
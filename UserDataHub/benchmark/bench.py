@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.web import create_signed_value
+
+from ..users import UserConfigurator, NFSUserConfigurator
+
+
+def summarize(times):
+    """
+    Summarize a list of durations in seconds.
+    """
+    times = sorted(times)
+    return {
+        'count': len(times),
+        'total': sum(times),
+        'min': times[0],
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'p95': times[min(int(len(times) * 0.95), len(times) - 1)],
+        'p99': times[min(int(len(times) * 0.99), len(times) - 1)],
+        'max': times[-1],
+    }
+
+def time_repeated(func, repeat):
+    """
+    Call func `repeat` times and summarize how long it took. The last result
+    is returned too.
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return summarize(times), result
+
+def time_each(func, items):
+    """
+    Call func once for every item and summarize how long each call took.
+    """
+    times = []
+    for item in items:
+        start = time.perf_counter()
+        func(item)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+def benchmark_configurators(section_dict, root_path, repeat=3, parent=None):
+    """
+    Time building both configurators and looking up and provisioning every
+    user. Every NFSUserConfigurator is built on a fresh folder under
+    root_path, so the folder creation is always timed from scratch.
+    """
+    results = {}
+    os.makedirs(root_path, exist_ok=True)
+
+    results['user_configurator_init'], configurator = time_repeated(
+        lambda: UserConfigurator(section_dict, parent=parent), repeat)
+
+    roots = ("%s/nfs%i" % (root_path, i) for i in itertools.count())
+    def build_nfs():
+        root = next(roots)
+        return NFSUserConfigurator(section_dict, root_path=root, user_section_base_folder=root, parent=parent)
+    results['nfs_user_configurator_init'], configurator = time_repeated(build_nfs, repeat)
+
+    usernames = list(configurator.user_dict)
+    results['get_user_data'] = time_each(configurator.get_user_data, usernames)
+    results['get_encoded_user_data'] = time_each(configurator.get_encoded_user_data, usernames)
+    # The first pass creates the home folders and the second finds them in place.
+    results['create_home_folder'] = time_each(configurator.create_home_folder, usernames)
+    results['create_home_folder_existing'] = time_each(configurator.create_home_folder, usernames)
+
+    return results
+
+def get_free_port():
+    """
+    Ask the OS for a port that nothing is listening on.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(user_data_file, root_path, work_dir, cookie_secret, port, num_processes=1):
+    """
+    Start UserDataHub in a separate process so that the load test client
+    doesn't share its IOLoop.
+    """
+    env = dict(os.environ, USERDATAHUB_COOKIE_SECRET=cookie_secret.hex())
+    args = [
+        sys.executable, '-m', 'UserDataHub.app',
+        '--UserDataHub.config_file=%s' % os.path.join(work_dir, 'userdatahub_config.py'),
+        '--UserDataHub.user_data_file=%s' % user_data_file,
+        '--UserDataHub.db_url=sqlite:///%s' % os.path.join(work_dir, 'userdatahub.sqlite'),
+        '--UserDataHub.port=%i' % port,
+        '--UserDataHub.num_processes=%i' % num_processes,
+        '--NFSUserConfigurator.root_path=%s' % root_path,
+        '--NFSUserConfigurator.user_section_base_folder=%s' % root_path,
+        '--log_level=WARN',
+    ]
+    return subprocess.Popen(args, cwd=work_dir, env=env)
+
+async def wait_for_server(url, process, timeout=600):
+    """
+    Wait until the server answers health checks.
+    """
+    client = AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("UserDataHub exited with status %i before it was ready." % process.returncode)
+        try:
+            response = await client.fetch(url + '/health', raise_error=False)
+            if response.code == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("UserDataHub was not ready after %i seconds." % timeout)
+
+async def run_load_test(url, cookie_secret, usernames, requests=1000, concurrency=32):
+    """
+    Send `requests` /get-user requests with validly signed user cookies,
+    keeping `concurrency` of them in flight, and summarize the latencies.
+    """
+    # The shared client of the IOLoop ignores max_clients once it exists, so
+    # use a separate one that really has `concurrency` connections.
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    tokens = [create_signed_value(cookie_secret, 'user_data', username).decode('ascii') for username in usernames]
+    pending = iter(range(requests))
+    latencies = []
+    statuses = {}
+
+    async def worker():
+        for i in pending:
+            start = time.perf_counter()
+            response = await client.fetch(url + '/get-user?user=' + tokens[i % len(tokens)], raise_error=False)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.code] = statuses.get(response.code, 0) + 1
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        client.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'elapsed': elapsed,
+        'requests_per_second': requests / elapsed,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'latency': summarize(latencies),
+    }
+
+async def benchmark_http(user_data_file, root_path, work_dir, usernames, requests=1000, concurrency=32,
+                         num_processes=1):
+    """
+    Start a server on the roster and load test /get-user. The first round
+    creates the home folders and the second finds them already provisioned.
+    """
+    os.makedirs(root_path, exist_ok=True)
+    cookie_secret = os.urandom(32)
+    port = get_free_port()
+    url = 'http://127.0.0.1:%i' % port
+    process = start_server(user_data_file, root_path, work_dir, cookie_secret, port, num_processes)
+    try:
+        start = time.perf_counter()
+        await wait_for_server(url, process)
+        results = {'startup': time.perf_counter() - start}
+        results['get_user_cold'] = await run_load_test(url, cookie_secret, usernames, requests, concurrency)
+        results['get_user_warm'] = await run_load_test(url, cookie_secret, usernames, requests, concurrency)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return results
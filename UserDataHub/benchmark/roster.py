@@ -0,0 +1,114 @@
+import random
+
+import yaml
+
+
+def get_config_blob(rng, config_size, prefix):
+    """
+    Make a configAppend or configOverride blob with about config_size entries.
+    """
+    blob = {'env': {"%s_%i" % (prefix, i): "%08x" % rng.getrandbits(32) for i in range(config_size)}}
+    if rng.random() < 0.5:
+        blob['volume_mounts'] = [{'name': "%s-volume" % prefix.lower(), 'mountPath': "/mnt/%s" % prefix.lower()}]
+    return blob
+
+def generate_section(rng, usernames, level, depth, sections, groups, members, users_per_section, config_size, admin_fraction):
+    """
+    Make one section and, recursively, its subsections.
+    """
+    section = {
+        'configAppend': get_config_blob(rng, config_size, 'APPEND_%i' % level),
+        'configOverride': get_config_blob(rng, config_size, 'OVERRIDE_%i' % level),
+    }
+
+    section_users = rng.sample(usernames, min(users_per_section, len(usernames)))
+    section['users'] = {}
+    for username in section_users:
+        user = {}
+        if rng.random() < admin_fraction:
+            user['admin'] = True
+        if rng.random() < 0.1:
+            user['configOverride'] = get_config_blob(rng, config_size, 'USER')
+        section['users'][username] = user
+
+    section['groups'] = {}
+    for i in range(groups):
+        group = {
+            'members': rng.sample(section_users, min(members, len(section_users))),
+            'configAppend': get_config_blob(rng, config_size, 'GROUP'),
+        }
+        if i == 0:
+            group['properties'] = {'everyone': True}
+        elif rng.random() < 0.25:
+            group['properties'] = {'readOnly': True}
+        section['groups']["group%i" % i] = group
+
+    if level < depth:
+        section['sections'] = {
+            "section%i" % i: generate_section(rng, section_users, level + 1, depth, sections, groups, members,
+                                              users_per_section, config_size, admin_fraction)
+            for i in range(sections)
+        }
+
+    return section
+
+def generate_roster(depth=2,
+                    sections=4,
+                    groups=4,
+                    members=25,
+                    users=1000,
+                    users_per_section=250,
+                    config_size=4,
+                    admin_fraction=0.01,
+                    seed=0):
+    """
+    Make a synthetic section_dict in the same format as user_data.yaml. There
+    are `sections` top level sections, each with `sections` subsections down
+    to `depth` levels. Every section has `users_per_section` users drawn from
+    its parent and `groups` groups of `members` users. The config blobs have
+    `config_size` environment variables each. The same seed always gives the
+    same roster.
+    """
+    rng = random.Random(seed)
+    usernames = ["user%06i" % i for i in range(users)]
+
+    roster = {
+        'enableCustomAllowed': True,
+        'custom': {'motd': 'benchmark'},
+        'configAppend': get_config_blob(rng, config_size, 'ROOT'),
+        'configOverride': get_config_blob(rng, config_size, 'ROOT'),
+        'users': {},
+    }
+    if depth > 0:
+        roster['sections'] = {
+            "section%i" % i: generate_section(rng, usernames, 1, depth, sections, groups, members,
+                                              users_per_section, config_size, admin_fraction)
+            for i in range(sections)
+        }
+    return roster
+
+def count_roster(section_dict):
+    """
+    Count the users, sections and groups in a section_dict.
+    """
+    users = set()
+    section_count = 0
+    group_count = 0
+    stack = [section_dict]
+    while stack:
+        section = stack.pop()
+        section_count += 1
+        users.update(section.get('users') or {})
+        group_count += len(section.get('groups') or {})
+        stack.extend((section.get('sections') or {}).values())
+    return {'users': len(users), 'sections': section_count, 'groups': group_count}
+
+def write_roster(section_dict, path):
+    """
+    Write the section_dict to a YAML file and return its size in bytes.
+    """
+    dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    data = yaml.dump(section_dict, Dumper=dumper, default_flow_style=False).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data)
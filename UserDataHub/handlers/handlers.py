@@ -1,16 +1,22 @@
 from tornado import web
+from tornado.iostream import StreamClosedError
 from tornado.httputil import url_concat, split_host_and_port
 from urllib.parse import urlparse, parse_qs, parse_qsl, urlunparse, urlencode
 from tornado.log import app_log
 import time
+import asyncio
+import bisect
 from copy import deepcopy
 
 from tornado_sqlalchemy import as_future, SessionMixin, SQLAlchemy
 
 import json
 
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
 from ..utils import url_path_join
 from ..orm import User
+from ..metrics import REQUEST_COUNT, REQUEST_STAGE_DURATION_SECONDS, get_registry
 
 class BaseHandler(SessionMixin, web.RequestHandler):
     @property
@@ -21,6 +27,10 @@ class BaseHandler(SessionMixin, web.RequestHandler):
     def db(self):
         return self.settings.get('db')
 
+    def on_finish(self):
+        REQUEST_COUNT.labels(handler=type(self).__name__, status=self.get_status()).inc()
+        super().on_finish()
+
 class Template404(BaseHandler):
     """Render our 404 template"""
 
@@ -35,28 +45,50 @@ class UserAPI(BaseHandler):
     def configurator(self):
         return self.settings.get('configurator')
 
+    @property
+    def provisioner(self):
+        return self.settings.get('provisioner')
+
     @property
     def auth_token_valid_time(self):
         return self.settings.get('auth_token_valid_time')
 
+    def get_user_data_encoder(self, configurator):
+        """
+        Get the function that encodes a user's data in the format that was
+        asked for. With `format=merged`, the configs are merged into one
+        instead of being listed for every section and group.
+        """
+        response_format = self.get_argument('format', 'full')
+        if response_format == 'full':
+            return configurator.get_encoded_user_data
+        elif response_format == 'merged':
+            return configurator.get_encoded_merged_user_data
+        self.log.warning("Unknown response format %r." % response_format)
+        raise web.HTTPError(400)
+
 class GetUser(UserAPI):
 
-    def get(self):
+    async def get(self):
         if self.get_argument('user', False):
-            user = self.get_secure_cookie(name='user_data', value=self.get_argument('user'), max_age_days=self.auth_token_valid_time/86400)
+            get_encoded_user_data = self.get_user_data_encoder(self.configurator)
+            with REQUEST_STAGE_DURATION_SECONDS.labels(stage='verify').time():
+                user = self.get_secure_cookie(name='user_data', value=self.get_argument('user'), max_age_days=self.auth_token_valid_time/86400)
             self.log.debug("auth_token_valid_time is %r" % self.auth_token_valid_time)
             if user is not None:
                 user = user.decode('utf-8')
                 self.set_header('Content-Type', 'text/plain')
-                user_data = self.configurator.get_user_data(user)
-                if user_data is None:
+                with REQUEST_STAGE_DURATION_SECONDS.labels(stage='user_data').time():
+                    encoded_data = get_encoded_user_data(user)
+                if encoded_data is None:
                     self.log.warning("User %r tried to log in but was not on the allowed list." % user)
                     raise web.HTTPError(403)
 
-                self.configurator.create_home_folder(user)
-                
-                encoded_data = json.dumps(user_data).encode('utf-8')
-                signed_data = self.create_signed_value(name='user_data', value=encoded_data)
+                with REQUEST_STAGE_DURATION_SECONDS.labels(stage='provision').time():
+                    await self.provisioner.provision(user)
+
+                with REQUEST_STAGE_DURATION_SECONDS.labels(stage='sign').time():
+                    signed_data = self.create_signed_value(name='user_data', value=encoded_data)
                 
                 self.write(signed_data)
 
@@ -71,9 +103,92 @@ class GetUser(UserAPI):
 
         self.finish()
 
+class GetUserBatch(UserAPI):
+    """
+    Returns the data for many users at once. The body of the request is a
+    signed JSON list of usernames. The response is streamed with one JSON
+    object per line as each user's folders are ready, holding either the
+    signed user data (exactly as /get-user returns it) or an error code.
+    """
+
+    @property
+    def max_batch_size(self):
+        return self.settings.get('max_batch_size')
+
+    async def post(self):
+        value = self.get_secure_cookie(name='user_batch', value=self.request.body, max_age_days=self.auth_token_valid_time/86400)
+        if value is None:
+            self.log.warning("Query is malformed for batch user access.")
+            raise web.HTTPError(400)
+
+        try:
+            usernames = json.loads(value.decode('utf-8'))
+        except ValueError:
+            usernames = None
+        if not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames):
+            self.log.warning("Batch user access is not a list of usernames.")
+            raise web.HTTPError(400)
+        if len(usernames) > self.max_batch_size:
+            self.log.warning("Batch of %i users is larger than the maximum of %i." % (len(usernames), self.max_batch_size))
+            raise web.HTTPError(400)
+
+        self.set_header('Content-Type', 'application/x-ndjson')
+
+        # Use the same configurator for the whole batch even if it is reloaded.
+        get_encoded_user_data = self.get_user_data_encoder(self.configurator)
+        encoded_data = {}
+        for username in dict.fromkeys(usernames):
+            encoded_data[username] = get_encoded_user_data(username)
+            if encoded_data[username] is None:
+                self.log.warning("User %r was requested in a batch but was not on the allowed list." % username)
+                self.write_line({'user': username, 'error': 403})
+
+        pending = [self.provision(username) for username, data in encoded_data.items() if data is not None]
+        for future in asyncio.as_completed(pending):
+            username, error = await future
+            if error is not None:
+                self.write_line({'user': username, 'error': error})
+            else:
+                signed_data = self.create_signed_value(name='user_data', value=encoded_data[username])
+                self.write_line({'user': username, 'data': signed_data.decode('ascii')})
+            try:
+                await self.flush()
+            except StreamClosedError:
+                # The folders of the remaining users are still created, since
+                # the provisioning jobs are shielded from this request.
+                self.log.debug("The client went away during a batch of %i users." % len(usernames))
+                return
+
+        self.finish()
+
+    async def provision(self, username):
+        try:
+            await self.provisioner.provision(username)
+        except Exception:
+            self.log.exception("Failed to create the home folder for %r." % username)
+            return username, 500
+        return username, None
+
+    def write_line(self, data):
+        self.write(json.dumps(data) + '\n')
+
+
 class GetUsers(UserAPI):
+    """
+    Lists the users. Without the `limit` and `cursor` arguments, this is a
+    mapping of every user to their data as it always was. With either of them,
+    the users are listed one page at a time as `{"users": ..., "next": ...}`.
+    Pages are ordered by username, and the `cursor` argument is the `next` of
+    the previous page. The users can be filtered by `section` (a path like
+    `course1/sec1`), `group` (within the section if one is given) and `admin`
+    (`true` or `false`).
+    """
 
-    def get(self):
+    @property
+    def users_page_size(self):
+        return self.settings.get('users_page_size')
+
+    async def get(self):
         if self.get_argument('all', False):
             value = self.get_secure_cookie(name='all_user_data', value=self.get_argument('all'), max_age_days=self.auth_token_valid_time/86400)
             if value is not None:
@@ -81,12 +196,53 @@ class GetUsers(UserAPI):
                 if not value == "all":
                     self.log.warning("Attempted access of user list, but malformed query.")
                     raise web.HTTPError(400)
+
+                limit = self.get_argument('limit', None)
+                cursor = self.get_argument('cursor', None)
+                paged = limit is not None or cursor is not None
+                if paged:
+                    try:
+                        limit = max(min(int(limit or self.users_page_size), self.users_page_size), 1)
+                    except ValueError:
+                        self.log.warning("Attempted access of user list, but the limit is not a number.")
+                        raise web.HTTPError(400)
+                section = self.get_argument('section', None)
+                section_path = tuple(name for name in section.split('/') if name) if section is not None else None
+                group = self.get_argument('group', None)
+                admin = self.get_argument('admin', None)
+                if admin is not None:
+                    admin = admin.lower() in ('1', 'true', 'yes')
+
                 self.set_header('Content-Type', 'text/plain')
+
+                # Use the same configurator for the whole page even if it is reloaded.
+                configurator = self.configurator
+                if paged:
+                    usernames = configurator.get_sorted_usernames()
+                    start = bisect.bisect_right(usernames, cursor) if cursor else 0
+                else:
+                    usernames = list(configurator.user_dict)
+                    start = 0
+
                 data = {}
-                for key in self.configurator.user_dict.keys():
-                    data[key] = {'admin': self.configurator.user_dict[key].get('admin', False)}
+                next_cursor = None
+                last_username = None
+                for i in range(start, len(usernames)):
+                    username = usernames[i]
+                    user_data = configurator.get_user_data(username)
+                    if self.user_matches(user_data, section_path, group, admin):
+                        if paged and len(data) >= limit:
+                            # There is at least one more user, so point to the last one on this page.
+                            next_cursor = last_username
+                            break
+                        data[username] = {'admin': user_data.admin}
+                        last_username = username
+                    # Let other requests through while scanning large rosters.
+                    if (i - start) % 1000 == 999:
+                        await asyncio.sleep(0)
 
-                
+                if paged:
+                    data = {'users': data, 'next': next_cursor}
                 encoded_data = json.dumps(data).encode('utf-8')
                 signed_data = self.create_signed_value(name='all_user_data', value=encoded_data)
                 
@@ -102,6 +258,30 @@ class GetUsers(UserAPI):
 
         self.finish()
 
+    def user_matches(self, user_data, section_path, group, admin):
+        """
+        Whether or not the user passes the filters.
+        """
+        if admin is not None and bool(user_data.admin) != admin:
+            return False
+        if section_path is None and group is None:
+            return True
+
+        for section in user_data.sections:
+            if section_path is not None and section.section_path != section_path:
+                continue
+            if group is None or any(user_group.group_name == group for user_group in section.groups):
+                return True
+        return False
+
+class MetricsHandler(BaseHandler):
+    """Export the Prometheus metrics"""
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.write(generate_latest(get_registry()))
+        self.finish()
+
 class HealthCheckHandler(BaseHandler):
     """Answer to health check"""
 
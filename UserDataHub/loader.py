@@ -0,0 +1,285 @@
+from traitlets.config import LoggingConfigurable
+from traitlets import Unicode
+
+import os
+import pickle
+import hashlib
+import tempfile
+
+from ._version import __version__
+from .utils import load_yaml
+
+YAML_EXTENSIONS = ('.yaml', '.yml')
+
+
+class UserDataLoader(LoggingConfigurable):
+    """
+    Loads the section_dict from the user data, which is either a single YAML
+    file or a directory of them. In a directory, every YAML file is a section
+    named after the file (e.g. `course1.yaml` is the section `course1`), every
+    subdirectory is a section with its own files as subsections, and the
+    `root_file_name` file holds the settings, users and groups of the
+    directory's own section. A file next to a subdirectory with the same name
+    (e.g. `course1.yaml` next to `course1/`) is used in the same way as the
+    subdirectory's `root_file_name` file, though keeping it in
+    `course1/_root.yaml` is clearer.
+
+    Every file is tracked separately. On a reload, only files that changed on
+    disk are read and parsed again, and the parts of the tree that didn't
+    change are the same objects as before, so the configurator only
+    recomputes the users in the sections that changed.
+    """
+
+    root_file_name = Unicode(
+        default_value="_root.yaml",
+        help="""
+        The name of the file in a user data directory that holds the settings
+        of the directory itself rather than of a subsection.
+        """
+    ).tag(config=True)
+
+    cache_file = Unicode(
+        default_value="",
+        help="""
+        File in which to cache the parsed user data files. Files whose contents
+        match the cache aren't parsed again. The cache is ignored unless it is
+        owned by the user UserDataHub runs as and only that user can write it.
+        Leave empty to disable the cache.
+        """
+    )
+
+    def __init__(self, path, cache_file="", **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.cache_file = cache_file
+        # The state of every file keyed by its path relative to self.path:
+        # (stat key, sha256 of the contents, parsed contents).
+        self._files = {}
+        # The parsed contents of files from the cache keyed by relative path: (sha256, parsed contents).
+        self._cached = None
+        # The assembled section of every directory keyed by relative path: (parts, section).
+        self._directories = {}
+
+    def is_directory(self):
+        return os.path.isdir(self.path)
+
+    def list_files(self):
+        """
+        List the YAML files that make up the user data relative to self.path.
+        Hidden files and folders are skipped.
+        """
+        if not self.is_directory():
+            return [""]
+
+        files = []
+        for directory, subdirectories, filenames in os.walk(self.path):
+            subdirectories[:] = sorted(name for name in subdirectories if not name.startswith('.'))
+            relative = os.path.relpath(directory, self.path)
+            for filename in sorted(filenames):
+                if not filename.startswith('.') and filename.endswith(YAML_EXTENSIONS):
+                    files.append(os.path.normpath(os.path.join(relative, filename)))
+        return files
+
+    def get_file_path(self, relative_path):
+        if not relative_path:
+            return self.path
+        return os.path.join(self.path, relative_path)
+
+    def get_stat_key(self, relative_path):
+        stat = os.stat(self.get_file_path(relative_path))
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def get_signature(self):
+        """
+        Something that changes whenever the user data changes on disk. This is
+        the mtime for a single file, and the mtimes and sizes of all of the
+        files for a directory, so that edits, new files and removed files are
+        all noticed.
+        """
+        try:
+            if not self.is_directory():
+                return os.stat(self.path).st_mtime
+            return tuple((relative_path, self.get_stat_key(relative_path)) for relative_path in self.list_files())
+        except OSError:
+            return None
+
+    def load_file(self, relative_path):
+        """
+        Get the sha256 and the parsed contents of a file. Unless the file
+        changed on disk, this is what was loaded last time without reading it.
+        """
+        stat_key = self.get_stat_key(relative_path)
+        previous = self._files.get(relative_path)
+        if previous is not None and previous[0] == stat_key:
+            return previous[1], previous[2], False
+
+        with open(self.get_file_path(relative_path), 'rb') as f:
+            data = f.read()
+        sha = hashlib.sha256(data).hexdigest()
+
+        parsed = False
+        if previous is not None and previous[1] == sha:
+            section = previous[2]
+        elif self._cached is not None and self._cached.get(relative_path, (None,))[0] == sha:
+            section = self._cached[relative_path][1]
+        else:
+            self.log.debug("Parsing %s." % self.get_file_path(relative_path))
+            section = load_yaml(data)
+            parsed = True
+
+        self._files[relative_path] = (stat_key, sha, section)
+        return sha, section, parsed
+
+    def load(self, save_cache=True):
+        """
+        Load the section_dict. This returns the section_dict and a hash of
+        all of the files it was loaded from.
+        """
+        if self._cached is None:
+            self._cached = self.load_cache()
+
+        files = self.list_files()
+        hashes = []
+        sections = {}
+        parsed = 0
+        for relative_path in files:
+            sha, section, was_parsed = self.load_file(relative_path)
+            hashes.append((relative_path, sha))
+            sections[relative_path] = section
+            parsed += was_parsed
+        # Forget files that were removed.
+        for relative_path in self._files.keys() - sections.keys():
+            del self._files[relative_path]
+
+        self.log.info("Parsed %i of %i user data files." % (parsed, len(files)))
+        if parsed and save_cache:
+            self.save_cache()
+        # The cache is only needed to start up.
+        self._cached = {}
+
+        if not self.is_directory():
+            return sections[""], hashes[0][1]
+
+        source_hash = hashlib.sha256(repr(hashes).encode('utf-8')).hexdigest()
+        return self.get_directory_section(".", sections), source_hash
+
+    def get_directory_section(self, directory, sections, file_path=None):
+        """
+        Assemble the section for a directory from its files and subdirectories.
+        file_path is the file next to the directory with the same name, if
+        there is one. If none of them changed, the section from last time is
+        reused.
+        """
+        root_path = os.path.normpath(os.path.join(directory, self.root_file_name))
+        if file_path is not None:
+            if root_path in sections:
+                self.log.warning("The section %r is defined in %s and in %s. Ignoring %s."
+                                 % (directory, os.path.join(self.path, file_path),
+                                    os.path.join(self.path, root_path), os.path.join(self.path, file_path)))
+            else:
+                root_path = file_path
+        root = sections.get(root_path)
+        if root is not None and type(root) is not dict:
+            self.log.warning("%s is not a dictionary. Ignoring it." % os.path.join(self.path, root_path))
+            root = None
+
+        subsections = {}
+        # The files that are subsections keyed by section name.
+        file_paths = {}
+        subdirectories = set()
+        prefix = "" if directory == "." else directory + os.sep
+        for relative_path, section in sections.items():
+            if relative_path == root_path or not relative_path.startswith(prefix):
+                continue
+            name, _, rest = relative_path[len(prefix):].partition(os.sep)
+            if rest:
+                # This is in a subdirectory, so make the subdirectory a section
+                # once. The files of a directory are listed before its
+                # subdirectories, so a file with the same name is already known.
+                if name not in subdirectories:
+                    subdirectories.add(name)
+                    subsections[name] = self.get_directory_section(prefix + name, sections, file_paths.get(name))
+            else:
+                name = os.path.splitext(name)[0]
+                file_paths[name] = relative_path
+                subsections[name] = section
+
+        parts = (root, tuple(subsections.items()))
+        previous = self._directories.get(directory)
+        if previous is not None and self.same_parts(previous[0], parts):
+            return previous[1]
+
+        section = dict(root) if root is not None else {}
+        if subsections:
+            merged_subsections = dict(section.get("sections") or {})
+            for name in subsections:
+                if name in merged_subsections:
+                    self.log.warning("Section %r is defined in %s and in its own file. Using its own file."
+                                     % (name, os.path.join(self.path, root_path)))
+            merged_subsections.update(subsections)
+            section["sections"] = merged_subsections
+
+        self._directories[directory] = (parts, section)
+        return section
+
+    def same_parts(self, a, b):
+        """
+        Whether or not two sets of parts are made of the same objects.
+        """
+        return (a[0] is b[0] and len(a[1]) == len(b[1])
+                and all(name_a == name_b and section_a is section_b
+                        for (name_a, section_a), (name_b, section_b) in zip(a[1], b[1])))
+
+    def load_cache(self):
+        """
+        Load the parsed files from the cache if it was written by this version.
+        """
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as f:
+                # Unpickling runs code, so only trust a cache that nobody else could have written.
+                if os.name != 'nt':  # Windows permissions don't follow POSIX rules
+                    stat = os.fstat(f.fileno())
+                    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+                        self.log.warning("Ignoring the user data cache %s since it isn't owned by this user "
+                                         "or can be written by others." % self.cache_file)
+                        return {}
+                cache = pickle.load(f)
+        except Exception as e:
+            self.log.warning("Failed to read the user data cache %s: %s" % (self.cache_file, e))
+            return {}
+
+        if type(cache) is not dict or cache.get('version') != __version__ or cache.get('path') != os.path.abspath(self.path):
+            self.log.info("The user data cache %s is out of date." % self.cache_file)
+            return {}
+        self.log.info("Loaded %i parsed user data files from %s." % (len(cache['files']), self.cache_file))
+        return cache['files']
+
+    def save_cache(self):
+        """
+        Write the parsed files to the cache. The file is replaced at once so
+        that a crash never leaves half of a cache behind.
+        """
+        if not self.cache_file:
+            return
+
+        cache = {
+            'version': __version__,
+            'path': os.path.abspath(self.path),
+            'files': {relative_path: (sha, section) for relative_path, (stat_key, sha, section) in self._files.items()},
+        }
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix='.user_data_cache-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, self.cache_file)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except Exception as e:
+            self.log.warning("Failed to write the user data cache %s: %s" % (self.cache_file, e))
+            return
+        self.log.info("Wrote the parsed user data to %s." % self.cache_file)
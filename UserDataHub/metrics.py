@@ -0,0 +1,86 @@
+"""
+Prometheus metrics exported by UserDataHub at /metrics.
+
+With several worker processes, every scrape is answered by one of the
+workers, so set the PROMETHEUS_MULTIPROC_DIR environment variable to an empty
+directory before starting UserDataHub. The workers then write their metrics
+to files there and every scrape adds up the metrics of all of them.
+"""
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, multiprocess
+
+REQUEST_STAGE_DURATION_SECONDS = Histogram(
+    'userdatahub_request_stage_duration_seconds',
+    'Time spent in each stage of answering a user request',
+    ['stage'],
+)
+
+FILESYSTEM_OPERATION_DURATION_SECONDS = Histogram(
+    'userdatahub_filesystem_operation_duration_seconds',
+    'Time spent in each filesystem operation while creating folders',
+    ['operation'],
+)
+
+REQUEST_COUNT = Counter(
+    'userdatahub_requests_total',
+    'Number of requests by handler and status code',
+    ['handler', 'status'],
+)
+
+CONFIGURATOR_BUILD_DURATION_SECONDS = Histogram(
+    'userdatahub_configurator_build_duration_seconds',
+    'Time spent loading the user data file and building the configurator',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf')),
+)
+
+PREPROVISION_USERS = Counter(
+    'userdatahub_preprovision_users_total',
+    'Number of users handled by background pre-provisioning by result',
+    ['result'],
+)
+
+# Only one process pre-provisions, so the others add nothing to this.
+PREPROVISION_PENDING = Gauge(
+    'userdatahub_preprovision_pending_users',
+    'Number of users left to check in the current pre-provisioning run',
+    multiprocess_mode='livesum',
+)
+
+# Every process loads the same user data, so the last one to load it is right.
+# The mostrecent modes need prometheus_client 0.17 or later.
+USER_COUNT = Gauge('userdatahub_users', 'Number of users in the user data file',
+                   multiprocess_mode='livemostrecent')
+SECTION_COUNT = Gauge('userdatahub_sections', 'Number of sections in the user data file',
+                      multiprocess_mode='livemostrecent')
+GROUP_COUNT = Gauge('userdatahub_groups', 'Number of groups in the user data file',
+                    multiprocess_mode='livemostrecent')
+
+
+def get_registry():
+    """
+    Get the registry to export. In multiprocess mode, this collects the
+    metrics of all of the processes from PROMETHEUS_MULTIPROC_DIR.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def mark_process_dead(pid):
+    """
+    Drop the live gauges of a worker process that exited.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+def update_configurator_metrics(configurator):
+    """
+    Update the counts of users, sections and groups from a configurator.
+    """
+    USER_COUNT.set(len(configurator.user_dict))
+    SECTION_COUNT.set(len(configurator.section_paths))
+    GROUP_COUNT.set(configurator.get_group_count())
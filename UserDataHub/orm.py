@@ -1,4 +1,4 @@
-from sqlalchemy import BigInteger, Column, String, Unicode, Integer, JSON
+from sqlalchemy import BigInteger, Column, String, Unicode, Integer, JSON, inspect, text
 from sqlalchemy.types import TypeDecorator, Text
 from base64 import decodebytes
 from base64 import encodebytes
@@ -6,6 +6,8 @@ import json
 from tornado.log import app_log
 from tornado_sqlalchemy import SQLAlchemy
 
+from .records import UserRecord
+
 db = SQLAlchemy()
 db.Model.log = app_log
 
@@ -14,4 +16,121 @@ class User(db.Model):
 
     id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
     username = Column(Unicode(255), unique=True, nullable=False)
-    user_data = Column(JSON)
\ No newline at end of file
+    user_data = Column(JSON)
+    # Fingerprint of the folders and symlinks last created for the user.
+    home_fingerprint = Column(Unicode(64))
+    # Hash of the user data file (and settings) that user_data was built from.
+    source_hash = Column(Unicode(64), index=True)
+
+
+# Columns that were added to existing tables after they were first released.
+# create_all() only creates missing tables, so upgrade_db() adds these to
+# tables that were created by an older version.
+ADDED_COLUMNS = [
+    User.__table__.c.home_fingerprint,
+    User.__table__.c.source_hash,
+]
+
+
+def upgrade_db(db):
+    """
+    Add the columns in ADDED_COLUMNS that are missing from the database.
+    """
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for column in ADDED_COLUMNS:
+        table = column.table
+        if not inspector.has_table(table.name):
+            continue
+        if column.name in {c['name'] for c in inspector.get_columns(table.name)}:
+            continue
+
+        app_log.info("Adding the column %s to the %s table." % (column.name, table.name))
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+                preparer.format_table(table),
+                preparer.format_column(column),
+                column.type.compile(dialect=db.engine.dialect))))
+            for index in table.indexes:
+                if column.name in index.columns:
+                    index.create(connection, checkfirst=True)
+
+
+def load_home_fingerprints(db):
+    """
+    Load the home folder fingerprints of all provisioned users.
+    """
+    session = db.sessionmaker()
+    try:
+        query = session.query(User.username, User.home_fingerprint).filter(User.home_fingerprint.isnot(None))
+        return dict(query.all())
+    finally:
+        session.close()
+
+
+def save_home_fingerprint(db, username, fingerprint):
+    """
+    Store the home folder fingerprint for a user.
+    """
+    session = db.sessionmaker()
+    try:
+        user = session.query(User).filter_by(username=username).first()
+        if user is None:
+            user = User(username=username)
+            session.add(user)
+        user.home_fingerprint = fingerprint
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def load_user_dict(db, source_hash):
+    """
+    Load the user records that were built from the source with this hash.
+    Returns None if they were never stored.
+    """
+    session = db.sessionmaker()
+    try:
+        query = (session.query(User.username, User.user_data)
+                        .filter(User.source_hash == source_hash)
+                        .order_by(User.id))
+        # The records were all built from the same source, so they can share their sections and groups.
+        shared = {}
+        user_dict = {username: UserRecord.from_dict(user_data, shared) for username, user_data in query}
+    finally:
+        session.close()
+
+    return user_dict or None
+
+
+def save_user_dict(db, source_hash, user_dict):
+    """
+    Store the user records built from the source with this hash in a single
+    transaction. Users that are no longer in the user_dict are cleared, but
+    their rows are kept since they may hold other state.
+    """
+    session = db.sessionmaker()
+    try:
+        existing = dict(session.query(User.username, User.id))
+        updates = []
+        inserts = []
+        for username, user_data in user_dict.items():
+            values = {'username': username, 'user_data': user_data.to_dict(), 'source_hash': source_hash}
+            if username in existing:
+                values['id'] = existing.pop(username)
+                updates.append(values)
+            else:
+                inserts.append(values)
+        updates.extend({'id': user_id, 'user_data': None, 'source_hash': None} for user_id in existing.values())
+
+        session.bulk_update_mappings(User, updates)
+        session.bulk_insert_mappings(User, inserts)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
\ No newline at end of file
@@ -0,0 +1,242 @@
+from traitlets.config import LoggingConfigurable
+from traitlets import Any, Bool, Float, Integer
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .orm import load_home_fingerprints, save_home_fingerprint
+from .metrics import PREPROVISION_USERS, PREPROVISION_PENDING
+
+
+class HomeFolderProvisioner(LoggingConfigurable):
+    """
+    Runs the home folder set up for users on a bounded thread pool so that
+    slow NFS calls never block the IOLoop. Concurrent requests for the same
+    user share a single provisioning job, and users whose folders were already
+    created from the same sections and groups are skipped entirely.
+    """
+
+    max_workers = Integer(
+        default_value=8,
+        help="""
+        The maximum number of threads that can create home folders at once.
+        """
+    ).tag(config=True)
+
+    persist_provision_state = Bool(
+        default_value=False,
+        help="""
+        Whether or not to store which users have already been provisioned in
+        the database so that it survives restarts. If the folders can be
+        removed out from under UserDataHub, leave this off so that a restart
+        checks them all again.
+        """
+    ).tag(config=True)
+
+    preprovision = Bool(
+        default_value=False,
+        help="""
+        Whether or not to create the home folders of all known users in the
+        background after the user data is loaded or reloaded, so that they
+        are already in place when the users first log in. Users whose folders
+        are already up to date are skipped.
+        """
+    ).tag(config=True)
+
+    preprovision_rate = Float(
+        default_value=20,
+        help="""
+        The maximum number of home folders per second to create in the
+        background. Set to 0 for no limit.
+        """
+    ).tag(config=True)
+
+    preprovision_concurrency = Integer(
+        default_value=4,
+        help="""
+        The number of home folders to create in the background at once. These
+        share the thread pool with logins, so keep this below max_workers.
+        """
+    ).tag(config=True)
+
+    configurator = Any(
+        help="""
+        The configurator that knows how to create the home folders.
+        """
+    )
+
+    db = Any(
+        help="""
+        The database used to persist the provisioning state.
+        """
+    )
+
+    def __init__(self, configurator, db=None, **kwargs):
+        super().__init__(**kwargs)
+        self.configurator = configurator
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                           thread_name_prefix='provisioner')
+        # The provisioning jobs that are currently running keyed by username and
+        # fingerprint, so that a login after a reload doesn't join a job for
+        # the old folders.
+        self._pending = {}
+        # The fingerprint of the folders that were last created keyed by username.
+        self._provisioned = {}
+        # The running background pre-provisioning.
+        self._preprovision_task = None
+
+        if self.persist_provision_state and self.db is not None:
+            self.load_provision_state()
+
+    def load_provision_state(self):
+        """
+        Load the fingerprints of users that were provisioned by a previous run.
+        """
+        try:
+            self._provisioned.update(load_home_fingerprints(self.db))
+        except Exception as e:
+            self.log.warning("Failed to load the provisioning state. Every home folder will be checked again: %s" % e)
+            return
+        self.log.info("Loaded the provisioning state of %i users." % len(self._provisioned))
+
+    def save_provision_state(self, username, fingerprint):
+        """
+        Store the fingerprint for the user. This blocks, so it is only called
+        from the thread pool.
+        """
+        save_home_fingerprint(self.db, username, fingerprint)
+
+    def is_provisioned(self, username, fingerprint):
+        """
+        Whether or not the folders for this user are already up to date.
+        """
+        return fingerprint is not None and self._provisioned.get(username) == fingerprint
+
+    def forget(self, username=None):
+        """
+        Forget that a user (or every user) was provisioned so that the folders
+        are checked again on the next login.
+        """
+        if username is None:
+            self._provisioned.clear()
+        else:
+            self._provisioned.pop(username, None)
+
+    def _provision(self, username, fingerprint):
+        """
+        Create the folders and record the state. This runs in the thread pool.
+        """
+        self.configurator.create_home_folder(username)
+        if self.persist_provision_state and self.db is not None and fingerprint is not None:
+            try:
+                self.save_provision_state(username, fingerprint)
+            except Exception as e:
+                self.log.warning("Failed to store the provisioning state for %r: %s" % (username, e))
+        return fingerprint
+
+    async def provision(self, username):
+        """
+        Create the home folder for the user in the thread pool unless it is
+        already up to date. If a job for the same folders of this user is
+        already running, the running job is shared. This must be called from the IOLoop thread.
+        """
+        fingerprint = self.configurator.get_home_folder_fingerprint(username)
+        if self.is_provisioned(username, fingerprint):
+            self.log.debug("Home folder for %r is already provisioned." % username)
+            return
+
+        key = (username, fingerprint)
+        future = self._pending.get(key)
+        if future is None:
+            self.log.debug("Queueing home folder creation for %r." % username)
+            future = asyncio.wrap_future(self.executor.submit(self._provision, username, fingerprint))
+            self._pending[key] = future
+
+            def _done(f):
+                if self._pending.get(key) is f:
+                    del self._pending[key]
+                if not f.cancelled() and f.exception() is None and f.result() is not None:
+                    self._provisioned[username] = f.result()
+            future.add_done_callback(_done)
+        else:
+            self.log.debug("Joining running home folder creation for %r." % username)
+
+        # Shield the shared job so that a dropped request cannot cancel it
+        # for everybody else waiting on it.
+        await asyncio.shield(future)
+
+    def start_preprovision(self):
+        """
+        Start creating the home folders of all of the configurator's users in
+        the background, replacing any run that was started for an older
+        configurator. This must be called from the IOLoop thread.
+        """
+        if not self.preprovision:
+            return
+        self.stop_preprovision()
+        self._preprovision_task = asyncio.ensure_future(self.preprovision_all(self.configurator))
+
+    def stop_preprovision(self):
+        if self._preprovision_task is not None:
+            self._preprovision_task.cancel()
+            self._preprovision_task = None
+
+    async def preprovision_all(self, configurator):
+        """
+        Provision every user of the configurator, at most preprovision_rate
+        per second and preprovision_concurrency at once. Logins for a user
+        that is being pre-provisioned join the running job.
+        """
+        usernames = list(configurator.user_dict)
+        self.log.info("Pre-provisioning the home folders of %i users." % len(usernames))
+        PREPROVISION_PENDING.set(len(usernames))
+
+        loop = asyncio.get_event_loop()
+        interval = 1 / self.preprovision_rate if self.preprovision_rate > 0 else 0
+        next_start = loop.time()
+        pending = iter(usernames)
+        counts = {'provisioned': 0, 'skipped': 0, 'failed': 0}
+
+        async def worker():
+            nonlocal next_start
+            for username in pending:
+                PREPROVISION_PENDING.dec()
+                # Checking is cheap, so only the users that need folders count toward the rate.
+                if self.is_provisioned(username, configurator.get_home_folder_fingerprint(username)):
+                    result = 'skipped'
+                else:
+                    if interval:
+                        now = loop.time()
+                        delay = next_start - now
+                        next_start = max(next_start, now) + interval
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    try:
+                        await self.provision(username)
+                        result = 'provisioned'
+                    except Exception:
+                        self.log.exception("Failed to pre-provision the home folder for %r." % username)
+                        result = 'failed'
+                counts[result] += 1
+                PREPROVISION_USERS.labels(result=result).inc()
+
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*[worker() for _ in range(max(self.preprovision_concurrency, 1))])
+        except asyncio.CancelledError:
+            self.log.info("Stopped pre-provisioning after %(provisioned)i users." % counts)
+            raise
+        finally:
+            PREPROVISION_PENDING.set(0)
+
+        self.log.info("Pre-provisioned %i users (%i were up to date and %i failed) in %.1f seconds."
+                      % (counts['provisioned'], counts['skipped'], counts['failed'], time.perf_counter() - start))
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting new provisioning jobs.
+        """
+        self.stop_preprovision()
+        self.executor.shutdown(wait=wait)
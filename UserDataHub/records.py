@@ -0,0 +1,197 @@
+"""
+Compact record types for the user data.
+
+A record for every user in a large roster adds up, so instead of a tree of
+plain dicts every record uses __slots__ and shares what it can with the
+other users in the same sections. Records are only turned into the plain
+dicts of the JSON API by to_dict() at the edge, when they are encoded for a
+response or stored in the database. Records are shared between users and
+requests, so they must never be modified.
+
+from_dict() takes a `shared` dict that is kept for all of the records loaded
+together, so that records loaded from the database share their sections and
+groups in the same way as the ones the configurator builds. The records
+loaded together must come from the same user data, since a section's config
+and groups are looked up there by the section's path.
+"""
+import json
+
+
+def share_json(value, shared):
+    """
+    Get the JSON value with every dict, list and string in it replaced by an
+    equal one that was seen before, if there was one.
+    """
+    if type(value) is str:
+        return shared.setdefault(('str', value), value)
+    if type(value) is not dict and type(value) is not list:
+        return value
+
+    key = ('json', json.dumps(value))
+    if key in shared:
+        return shared[key]
+    # Only new values are taken apart, to share what they have in common with the others.
+    if type(value) is dict:
+        value = {share_json(name, shared): share_json(item, shared) for name, item in value.items()}
+    else:
+        value = [share_json(item, shared) for item in value]
+    shared[key] = value
+    return value
+
+
+class GroupRecord:
+    """
+    A group that a user is in. One is shared by all of the members.
+    """
+    __slots__ = ('group_name', 'read_only', 'config')
+
+    def __init__(self, group_name, read_only, config):
+        self.group_name = group_name
+        self.read_only = read_only
+        self.config = config
+
+    def to_dict(self):
+        return {'group_name': self.group_name,
+                'readOnly': self.read_only,
+                'config': self.config}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('group_name'), data.get('readOnly', False), data.get('config'))
+
+
+class SectionRecord:
+    """
+    A section that a user is in with the groups they are in there and their
+    own config for the section.
+    """
+    __slots__ = ('section_path', 'groups', 'config', 'user_config')
+
+    def __init__(self, section_path, groups, config, user_config):
+        self.section_path = section_path
+        self.groups = groups
+        self.config = config
+        self.user_config = user_config
+
+    def get_user_config(self, volume_mounts=None):
+        """
+        The volume mounts are added to the configAppend of the user_config, so
+        that they can't be overridden.
+        """
+        user_config = self.user_config
+        if volume_mounts is not None:
+            # Imported here since users imports this module.
+            from .users import merge
+            config_append = dict(user_config['configAppend'])
+            config_append['volume_mounts'] = merge(config_append.get('volume_mounts', None),
+                                                   [volume_mount.to_dict() for volume_mount in volume_mounts],
+                                                   append=True)
+            user_config = dict(user_config, configAppend=config_append)
+        return user_config
+
+    def to_dict(self, volume_mounts=None):
+        return {'section_path': list(self.section_path),
+                'groups': [group.to_dict() for group in self.groups],
+                'config': self.config,
+                'user_config': self.get_user_config(volume_mounts)}
+
+    @classmethod
+    def from_dict(cls, data, shared=None):
+        if shared is None:
+            shared = {}
+        section_path = tuple(data.get('section_path', ()))
+        groups = tuple(shared.setdefault(('group', section_path, group.get('group_name')), GroupRecord.from_dict(group))
+                       for group in data.get('groups', []))
+        # The user_config is the only part that can differ between the users in
+        # the same groups. Equal ones are the same object once shared.
+        user_config = share_json(data.get('user_config'), shared)
+        key = ('section', section_path, tuple(group.group_name for group in groups), id(user_config))
+        section = shared.get(key)
+        if section is None:
+            section = cls(section_path,
+                          groups,
+                          shared.setdefault(('config', section_path), data.get('config')),
+                          user_config)
+            shared[key] = section
+        return section
+
+
+class VolumeMount:
+    """
+    A volume mount for a group folder, or for the whole base folder when
+    sub_path is None.
+    """
+    __slots__ = ('mount_path', 'sub_path', 'name', 'read_only')
+
+    def __init__(self, mount_path, sub_path, name, read_only):
+        self.mount_path = mount_path
+        self.sub_path = sub_path
+        self.name = name
+        self.read_only = read_only
+
+    def to_dict(self):
+        if self.sub_path is None:
+            return {'mountPath': self.mount_path,
+                    'name': self.name,
+                    'readOnly': self.read_only}
+        return {'mountPath': self.mount_path,
+                'subPath': self.sub_path,
+                'name': self.name,
+                'readOnly': self.read_only}
+
+
+class GroupPaths:
+    """
+    The paths for a group folder: where it is mounted in the user's server,
+    its path below the base folder, the folder that the symlinks in the
+    home folders point to, and the volume mount for its members. These are
+    the same for every member, so they are built once per group.
+    """
+    __slots__ = ('mount_path', 'sub_path', 'target', 'volume_mount')
+
+    def __init__(self, mount_path, sub_path, target, volume_mount):
+        self.mount_path = mount_path
+        self.sub_path = sub_path
+        self.target = target
+        self.volume_mount = volume_mount
+
+
+class UserRecord:
+    """
+    Everything about a user. The sections are ordered from the root down.
+    When volume_mounts is not None, they are added to the user_config of the
+    last section when the record is serialized.
+    """
+    __slots__ = ('admin', 'sections', 'custom', 'root', 'volume_mounts')
+
+    def __init__(self, admin, sections, custom, root=(), volume_mounts=None):
+        self.admin = admin
+        self.sections = sections
+        self.custom = custom
+        self.root = root
+        self.volume_mounts = volume_mounts
+
+    def with_volume_mounts(self, volume_mounts):
+        return UserRecord(self.admin, self.sections, self.custom, self.root, volume_mounts)
+
+    def to_dict(self):
+        last = len(self.sections) - 1
+        return {'admin': self.admin,
+                'sections': [section.to_dict(self.volume_mounts if i == last else None)
+                             for i, section in enumerate(self.sections)],
+                'custom': self.custom,
+                'root': list(self.root)}
+
+    @classmethod
+    def from_dict(cls, data, shared=None):
+        """
+        Rebuild a record from to_dict(). The volume mounts are already part of
+        the last section's user_config, so they aren't split out again.
+        """
+        if shared is None:
+            shared = {}
+        root = tuple(data.get('root', ()))
+        return cls(data.get('admin', False),
+                   tuple(SectionRecord.from_dict(section, shared) for section in data.get('sections', [])),
+                   shared.setdefault(('custom',), data.get('custom')),
+                   shared.setdefault(('root', root), root))
@@ -0,0 +1,41 @@
+from traitlets.config import LoggingConfigurable
+from traitlets import Any
+
+from tornado_sqlalchemy import as_future
+
+from .orm import load_user_dict, save_user_dict
+
+
+class UserRepository(LoggingConfigurable):
+    """
+    Access to the user records stored in the database. Requests are answered
+    from the configurator in memory, so the database is only read when the
+    configurator is built and written after the user data is (re)loaded.
+    Writes run on the tornado_sqlalchemy thread pool so that they never
+    block the IOLoop.
+    """
+
+    db = Any(
+        help="""
+        The database that the user records are stored in.
+        """
+    )
+
+    def __init__(self, db, **kwargs):
+        super().__init__(**kwargs)
+        self.db = db
+
+    def load_user_dict(self, source_hash):
+        """
+        Get all of the records that were stored for the source with this hash,
+        or None if there are none. This blocks, so it is only called while
+        building a configurator, which happens off of the IOLoop.
+        """
+        return load_user_dict(self.db, source_hash)
+
+    async def save_user_dict(self, source_hash, user_dict):
+        """
+        Insert or update the records of all users in one transaction. This is
+        used after loading or reloading the user data file.
+        """
+        await as_future(lambda: save_user_dict(self.db, source_hash, user_dict))
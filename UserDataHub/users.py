@@ -1,14 +1,28 @@
 from traitlets.config import LoggingConfigurable
-from traitlets import Bool, Any, Unicode
+from traitlets import Bool, Any, Unicode, Integer, observe
 
 import yaml
 import os
 from pathlib import Path
-import copy
 import escapism
 import string
+import hashlib
+import json
 
+from collections import OrderedDict
 from collections.abc import Mapping
+import threading
+import sys
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import get_json_encoder
+from .metrics import FILESYSTEM_OPERATION_DURATION_SECONDS
+from .records import UserRecord, SectionRecord, GroupRecord, GroupPaths, VolumeMount
+from ._version import __version__
+
+# The permissions of the folders that are created.
+FOLDER_MODE = 0o750
 
 
 def merge(a, b, append=False):
@@ -17,29 +31,109 @@ def merge(a, b, append=False):
     overwite. For append, lists are appended, booleans take the max value
     seen (so if one is true, then the final is true), and strings are
     concatenated.
+
+    Neither a nor b is ever modified. Lists and dictionaries that are merged
+    are new objects, but values that are only in one of them are shared with
+    the result rather than copied.
     """
-    from collections.abc import Mapping
-    from numbers import Number
-    merged = b
-    if append and not b:
-        merged = a
     if isinstance(a, list) and isinstance(b, list):
-        merged = _merge_lists(a, b, append)
+        return _merge_lists(a, b, append)
     elif isinstance(a, str) and isinstance(b, str):
-        merged = _merge_strings(a, b, append)
+        return _merge_strings(a, b, append)
     elif isinstance(a, Mapping) and isinstance(b, Mapping):
-        merged = _merge_dictionaries(a, b, append)
+        return _merge_dictionaries(a, b, append)
+    elif append and not b:
+        return a
+    return b
+
+def merge_chain(values, append=False):
+    """
+    Merge a whole chain of values, such as the configs of a user's sections
+    from the root down, in one pass. This gives the same result as merging
+    them one at a time from left to right, but every key and list item is
+    only looked at once instead of once for every merge after it.
+    """
+    values = list(values)
+    if not values:
+        return None
+    if all(isinstance(value, Mapping) for value in values):
+        return _merge_dictionary_chain(values, append)
+    if all(isinstance(value, list) for value in values):
+        return _merge_list_chain(values, append)
+    if all(isinstance(value, str) for value in values):
+        return "".join(values) if append else values[-1]
+
+    merged = values[0]
+    for value in values[1:]:
+        merged = merge(merged, value, append)
     return merged
 
+def _get_merge_key(item):
+    """
+    This gets a hashable key for a list item that is equal for items that are
+    equal, so that appending lists can check for duplicates with a set.
+    Dictionaries (e.g. volume mounts) and lists are keyed by their contents.
+    Raises TypeError for items that can't be keyed.
+    """
+    try:
+        hash(item)
+        return item
+    except TypeError:
+        pass
+    if isinstance(item, Mapping):
+        return (Mapping, frozenset((key, _get_merge_key(value)) for key, value in item.items()))
+    elif isinstance(item, list):
+        return (list, tuple(_get_merge_key(value) for value in item))
+    elif isinstance(item, set):
+        return (set, frozenset(item))
+    raise TypeError("unhashable type: %r" % type(item).__name__)
+
+def _extend_unique(merged, seen, items):
+    """
+    Append the items that aren't in merged yet. seen holds the keys of
+    everything in merged.
+    """
+    for item in items:
+        try:
+            key = _get_merge_key(item)
+        except TypeError:
+            # Fall back to comparing with everything for items that can't be keyed.
+            if item not in merged:
+                merged.append(item)
+            continue
+        if key not in seen:
+            seen.add(key)
+            merged.append(item)
+
+def _get_merge_keys(items):
+    keys = set()
+    for item in items:
+        try:
+            keys.add(_get_merge_key(item))
+        except TypeError:
+            pass
+    return keys
+
 def _merge_lists(a, b, append=False):
     """
     Merge two lists.
     """
-    merged = b.copy()
-    if append:
-        temp_list = a
-        temp_list.extend(x for x in b if x not in temp_list)
-        merged = temp_list
+    if not append:
+        return list(b)
+    merged = list(a)
+    _extend_unique(merged, _get_merge_keys(merged), b)
+    return merged
+
+def _merge_list_chain(lists, append=False):
+    """
+    Merge a chain of lists.
+    """
+    if not append:
+        return list(lists[-1])
+    merged = list(lists[0])
+    seen = _get_merge_keys(merged)
+    for items in lists[1:]:
+        _extend_unique(merged, seen, items)
     return merged
 
 def _merge_strings(a, b, append=False):
@@ -56,15 +150,26 @@ def _merge_dictionaries(a,b, append=False):
     Simplified From https://stackoverflow.com/a/7205107
     and further modified from z2jh.py to merge lists and strings.
     """
-    from collections.abc import Mapping
-    merged = a.copy()
-    for key in b:
-        if key in a:
-            merged[key] = merge(a[key], b[key], append)
+    merged = dict(a)
+    for key, value in b.items():
+        if key in merged:
+            merged[key] = merge(merged[key], value, append)
         else:
-            merged[key] = b[key]
+            merged[key] = value
     return merged
 
+def _merge_dictionary_chain(dicts, append=False):
+    """
+    Merge a chain of dictionaries by collecting the values of every key
+    across the chain and merging those once.
+    """
+    values = {}
+    for dictionary in dicts:
+        for key, value in dictionary.items():
+            values.setdefault(key, []).append(value)
+    return {key: key_values[0] if len(key_values) == 1 else merge_chain(key_values, append)
+            for key, key_values in values.items()}
+
 
 def safeget(dct, keys, default=None):
     """
@@ -97,17 +202,26 @@ def intersperse(lst, item, prepend_if_nonzero=False):
 
 
 
-def create_directory(path, uid=1000, gid=100, mode=0o750, sticky_bit=False):
+def create_directory(path, uid=1000, gid=100, mode=FOLDER_MODE, sticky_bit=False):
     """
     Helper function to create directories with the proper ownership and permissions.
     """
-    import stat
     effective_mode = mode
     if sticky_bit:
         effective_mode = stat.S_ISGID | mode
-    path.mkdir(mode=0o750, exist_ok=True)
-    path.chmod(mode=effective_mode)
+    with FILESYSTEM_OPERATION_DURATION_SECONDS.labels(operation='mkdir').time():
+        path.mkdir(mode=FOLDER_MODE, exist_ok=True)
+    with FILESYSTEM_OPERATION_DURATION_SECONDS.labels(operation='chmod').time():
+        path.chmod(mode=effective_mode)
+
 
+def intern(value):
+    """
+    Intern strings so that names repeated across the records are only stored once.
+    """
+    if type(value) is str:
+        return sys.intern(value)
+    return value
 
 def get_escaped_string(value):
     """
@@ -118,6 +232,45 @@ def get_escaped_string(value):
 
 
 
+class LazyUserDict(Mapping):
+    """
+    A read only mapping from username to user record that builds each record
+    the first time it is looked up. Only the most recently used records are
+    kept, so memory follows the active users instead of every enrolled user.
+    """
+
+    def __init__(self, index, create_record, max_size=10000):
+        self.index = index
+        self.create_record = create_record
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        # Records can be looked up from the provisioner's threads as well.
+        self.lock = threading.Lock()
+
+    def __getitem__(self, username):
+        section_paths = self.index[username]
+        with self.lock:
+            if username in self.cache:
+                self.cache.move_to_end(username)
+                return self.cache[username]
+
+        record = self.create_record(username, section_paths)
+        with self.lock:
+            self.cache[username] = record
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        return record
+
+    def __contains__(self, username):
+        return username in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
 class UserConfigurator(LoggingConfigurable):
 
     enable_custom_allowed = Bool(
@@ -127,20 +280,94 @@ class UserConfigurator(LoggingConfigurable):
         """
     )
 
+    json_library = Unicode(
+        default_value="json",
+        help="""
+        The library used to encode the user data as JSON. This can be 'json',
+        'orjson' or 'ujson'. If the library isn't installed, the standard json
+        library is used.
+        """
+    ).tag(config=True)
+
+    lazy_user_dict = Bool(
+        default_value=False,
+        help="""
+        Whether or not to build user records on demand. When enabled, only an
+        index of which sections each user is in is built at startup, and the
+        full record of a user is built the first time it is looked up. The
+        folders of all sections and groups are still created at startup.
+        """
+    ).tag(config=True)
+
+    user_cache_size = Integer(
+        default_value=10000,
+        help="""
+        The number of user records to keep when lazy_user_dict is enabled. The
+        least recently used records are dropped first.
+        """
+    ).tag(config=True)
+
+    precompute_merged_config = Bool(
+        default_value=False,
+        help="""
+        Whether or not to build the merged config of every user when the user
+        data is loaded. Otherwise, it is built the first time a user asks for
+        it and the most recently used ones are kept.
+        """
+    ).tag(config=True)
+
     def __init__(self, 
                  section_dict, 
                  root_path = None, 
                  enable_custom_allowed = False,
+                 previous_configurator = None,
+                 source_hash = None,
+                 user_dict_loader = None,
                  **kwargs):
 
         super().__init__(**kwargs)
 
         self.log.info("Initializing the UserConfigurator")
+        # When reloading, the records of users whose sections didn't change are
+        # taken from the previous configurator instead of being rebuilt.
+        self.previous_configurator = previous_configurator
+        # If a loader is given, it is asked for records that were already built
+        # from the same source before building them again.
+        self.user_dict_loader = user_dict_loader
+        self.cache_key = self.get_cache_key(source_hash)
+        self.loaded_from_cache = False
         self.section_dict = self.get_section_dict(section_dict)
+        self.section_objects = {}
+        if self.lazy_user_dict:
+            # Nothing is reused when everything is built on demand, so don't
+            # spend the startup hashing every section.
+            self.section_digests = {}
+            self.section_paths = self.get_section_paths()
+        else:
+            self.section_digests = self.get_section_digests()
+            self.section_paths = list(self.section_digests)
+        self.group_index = {}
+        self.shared_section_data = {}
         self.user_dict = self.get_user_dict()
         self.enable_custom_allowed = self.section_dict.get('enableCustomAllowed', True)
+        self.json_encoder = get_json_encoder(self.json_library, log=self.log)
+        self.encoded_user_dict = self.get_encoded_user_dict()
+        self.encoded_merged_user_dict = self.get_encoded_merged_user_dict()
+        self.sorted_usernames = None
+        # Don't keep a chain of old configurators alive.
+        self.previous_configurator = None
 
 
+    def get_cache_key(self, source_hash):
+        """
+        This gets the key that stored user records are saved under. It changes
+        whenever the source or anything else the records depend on changes.
+        """
+        if source_hash is None:
+            return None
+        key = [source_hash, __version__, type(self).__name__]
+        return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
     def get_user_data(self, username):
         """
         This returns the user data if it exists. If not, it initializes it to default.
@@ -154,6 +381,110 @@ class UserConfigurator(LoggingConfigurable):
             user_data = self.create_user_dict(username)
             return user_data
 
+    def get_sorted_usernames(self):
+        """
+        This returns all known usernames in sorted order, which is what the
+        user listing pages through. It is only sorted the first time.
+        """
+        if self.sorted_usernames is None:
+            self.sorted_usernames = sorted(self.user_dict)
+        return self.sorted_usernames
+
+    def get_encoded_user_data(self, username):
+        """
+        This returns the user data encoded as JSON bytes. Known users are
+        encoded once when the configurator is loaded, so a reload (which
+        builds a new configurator) is what refreshes them.
+        """
+        if username in self.encoded_user_dict:
+            return self.encoded_user_dict[username]
+
+        user_data = self.get_user_data(username)
+        if user_data is None:
+            return None
+        return self.json_encoder(user_data.to_dict())
+
+    def get_encoded_user_dict(self):
+        """
+        Encodes the data for all known users.
+        """
+        if isinstance(self.user_dict, LazyUserDict):
+            return LazyUserDict(self.user_dict.index,
+                                lambda username, section_paths: self.json_encoder(self.get_user_data(username).to_dict()),
+                                max_size=self.user_cache_size)
+
+        self.log.info("Encoding the user_dict.")
+        previous = self.previous_configurator
+        if previous is not None and previous.json_library == self.json_library:
+            return {user: previous.encoded_user_dict[user] if user not in self.rebuilt_users
+                          else self.json_encoder(self.get_user_data(user).to_dict())
+                    for user in self.user_dict}
+        return {user: self.json_encoder(self.get_user_data(user).to_dict()) for user in self.user_dict}
+
+    def get_merged_user_data(self, username):
+        """
+        This returns the user data with the configs of all of the sections,
+        groups and the user merged into one, in the order of the sections from
+        the root down. In each section, the section's config comes first, then
+        the groups' configs by group name, then the user's config. The
+        configAppend values are appended and the configOverride values are
+        overridden, so the consumer doesn't need to merge anything.
+        """
+        user_data = self.get_user_data(username)
+        if user_data is None:
+            return None
+
+        configs = []
+        last = len(user_data.sections) - 1
+        for i, section in enumerate(user_data.sections):
+            configs.append(section.config)
+            configs.extend(group.config for group in section.groups)
+            configs.append(section.get_user_config(user_data.volume_mounts if i == last else None))
+
+        return {"admin": user_data.admin,
+                "sections": [{'section_path': list(section.section_path),
+                              'groups': [{'group_name': group.group_name, 'readOnly': group.read_only}
+                                         for group in section.groups]}
+                             for section in user_data.sections],
+                "custom": user_data.custom,
+                "root": list(user_data.root),
+                "config": {
+                    'configAppend': merge_chain([config.get('configAppend') or {} for config in configs if config], append=True) or {},
+                    'configOverride': merge_chain([config.get('configOverride') or {} for config in configs if config]) or {},
+                    }
+                }
+
+    def get_encoded_merged_user_data(self, username):
+        """
+        This returns the merged user data encoded as JSON bytes.
+        """
+        if username in self.encoded_merged_user_dict:
+            return self.encoded_merged_user_dict[username]
+
+        merged_user_data = self.get_merged_user_data(username)
+        if merged_user_data is None:
+            return None
+        return self.json_encoder(merged_user_data)
+
+    def get_encoded_merged_user_dict(self):
+        """
+        Encodes the merged data for all known users, or sets up building it on
+        demand if precompute_merged_config is off.
+        """
+        if not self.precompute_merged_config or isinstance(self.user_dict, LazyUserDict):
+            return LazyUserDict(self.user_dict,
+                                lambda username, user_data: self.json_encoder(self.get_merged_user_data(username)),
+                                max_size=self.user_cache_size)
+
+        self.log.info("Encoding the merged user_dict.")
+        previous = self.previous_configurator
+        if (previous is not None and previous.json_library == self.json_library
+                and not isinstance(previous.encoded_merged_user_dict, LazyUserDict)):
+            return {user: previous.encoded_merged_user_dict[user] if user not in self.rebuilt_users
+                          else self.json_encoder(self.get_merged_user_data(user))
+                    for user in self.user_dict}
+        return {user: self.json_encoder(self.get_merged_user_data(user)) for user in self.user_dict}
+
     def create_user_dict(self, username, path = []):
         """
         Creates the user dict if it doesn't exist.
@@ -164,12 +495,7 @@ class UserConfigurator(LoggingConfigurable):
         section_data = self.get_section_data(username, path)
         custom_data = self.get_custom_data()
 
-        default_user_data = {"admin": False,
-                             "sections": [section_data],
-                             "custom": custom_data,
-                             "root": copy.deepcopy(path)}
-
-        return default_user_data
+        return UserRecord(False, (section_data,), custom_data, tuple(path))
 
     def get_custom_data(self):
         if type(self.section_dict.get('custom')) is dict:
@@ -179,38 +505,118 @@ class UserConfigurator(LoggingConfigurable):
 
     def get_section_data(self, username, path):
         """
-        Get's the default section dict for a user dict.
+        Get's the default section dict for a user dict. The section and group
+        parts are shared by every user in the section and only the user_config
+        is specific to the user, so none of it may be modified.
         """
 
         section_data = safeget(self.section_dict, self.get_section_dict_key(path), {})
+        shared_section_data = self.get_shared_section_data(path)
 
-        user_section_data = {'section_path': copy.deepcopy(path),
-                             'groups': [],
-                             'config': {
-                                'configAppend': copy.deepcopy(section_data.get('configAppend', {})) or {},
-                                'configOverride': copy.deepcopy(section_data.get('configOverride', {})) or {},
-                                },
-                             'user_config': {
-                                'configAppend': copy.deepcopy(safeget(section_data, ['users', username, 'configAppend'], {})) or {},
-                                'configOverride': copy.deepcopy(safeget(section_data, ['users', username, 'configOverride'], {})) or {}
-                                }
-                            }
-
+        group_names = ()
         if type(section_data.get('groups')) is dict:
-            for group, group_data in section_data.get('groups', {}).items():
-                if username in group_data.get('members', []) or safeget(group_data, ['properties', 'everyone'], False):
-                    user_section_data['groups'].append({'group_name': group,
-                                                        'readOnly': safeget(group_data, ['properties', 'readOnly'], False),
-                                                        'config': {
-                                                            'configAppend': copy.deepcopy(group_data.get('configAppend', {})) or {},
-                                                            'configOverride': copy.deepcopy(group_data.get('configOverride', {})) or {},
-                                                            }
-                                                        })
-        
-        user_section_data["groups"].sort(key = lambda x: x["group_name"])
+            group_index = self.get_group_index(path)
+            group_names = group_index['everyone'].union(group_index['members'].get(username, ()))
+
+        user_data = safeget(section_data, ['users', username], {})
+        user_config_append = safeget(user_data, ['configAppend'], {}) or {}
+        user_config_override = safeget(user_data, ['configOverride'], {}) or {}
+        if user_config_append or user_config_override:
+            user_config = {'configAppend': user_config_append,
+                           'configOverride': user_config_override}
+            return SectionRecord(shared_section_data['section_path'],
+                                 self.get_group_records(shared_section_data, group_names),
+                                 shared_section_data['config'],
+                                 user_config)
+
+        # Users without their own config in the section are the same as
+        # everybody else in the same groups, so they share one record.
+        key = frozenset(group_names)
+        user_section_data = shared_section_data['records'].get(key)
+        if user_section_data is None:
+            user_section_data = SectionRecord(shared_section_data['section_path'],
+                                              self.get_group_records(shared_section_data, group_names),
+                                              shared_section_data['config'],
+                                              shared_section_data['empty_config'])
+            shared_section_data['records'][key] = user_section_data
 
         return user_section_data
 
+    def get_group_records(self, shared_section_data, group_names):
+        """
+        This gets the shared records of the groups sorted by name.
+        """
+        groups = shared_section_data['groups']
+        return tuple(groups[group] for group in sorted(group_names))
+
+    def get_shared_section_data(self, path):
+        """
+        This gets the parts of the section data that are the same for every
+        user in the section. They are built the first time a section is used
+        and then shared by all of the users' records instead of being copied.
+        """
+        key = tuple(path)
+        shared_section_data = self.shared_section_data.get(key)
+        if shared_section_data is not None:
+            return shared_section_data
+
+        section_data = safeget(self.section_dict, self.get_section_dict_key(path), {})
+
+        shared_section_data = {'section_path': tuple(intern(name) for name in path),
+                               'config': {
+                                   'configAppend': section_data.get('configAppend', {}) or {},
+                                   'configOverride': section_data.get('configOverride', {}) or {},
+                                   },
+                               'empty_config': {'configAppend': {}, 'configOverride': {}},
+                               'groups': {},
+                               'records': {}}
+
+        if type(section_data.get('groups')) is dict:
+            for group, group_data in section_data.get('groups', {}).items():
+                shared_section_data['groups'][group] = GroupRecord(
+                    intern(group),
+                    safeget(group_data, ['properties', 'readOnly'], False),
+                    {
+                        'configAppend': group_data.get('configAppend', {}) or {},
+                        'configOverride': group_data.get('configOverride', {}) or {},
+                    })
+
+        self.shared_section_data[key] = shared_section_data
+        return shared_section_data
+
+    def get_group_count(self):
+        """
+        This counts the groups in all of the sections.
+        """
+        group_count = 0
+        for path in self.section_paths:
+            groups = safeget(self.section_dict, self.get_section_dict_key(list(path), ['groups']))
+            if type(groups) is dict:
+                group_count += len(groups)
+        return group_count
+
+    def get_group_index(self, path):
+        """
+        This gets the groups of a section indexed by member so that finding a
+        user's groups doesn't scan every group's member list. The index is
+        built the first time a section is used.
+        """
+        key = tuple(path)
+        group_index = self.group_index.get(key)
+        if group_index is not None:
+            return group_index
+
+        group_index = {'everyone': set(), 'members': {}}
+        groups = safeget(self.section_dict, self.get_section_dict_key(path, ['groups']), {})
+        if type(groups) is dict:
+            for group, group_data in groups.items():
+                if safeget(group_data, ['properties', 'everyone'], False):
+                    group_index['everyone'].add(group)
+                for member in group_data.get('members', None) or []:
+                    group_index['members'].setdefault(member, set()).add(group)
+
+        self.group_index[key] = group_index
+        return group_index
 
     def get_section_dict_key(self, section_list, sub_item_list = []):
         """
@@ -220,95 +626,205 @@ class UserConfigurator(LoggingConfigurable):
 
 
 
-    def get_users_from_sections(self, user_dict=None, path=None):
+    def get_section_closure(self, section_paths):
+        """
+        This gets every section path in the list along with all of their
+        ancestors (including the root) as a set of tuples.
         """
-        This creates the user dictionary that includes the section the user is
-        in, the groups that they are in, and the relevant configuration
-        parameters.
+        closure = set()
+        for section_path in section_paths:
+            section_path = tuple(section_path)
+            for i in range(len(section_path), -1, -1):
+                # If this ancestor is already in the set, so are all of its ancestors.
+                if section_path[0:i] in closure:
+                    break
+                closure.add(section_path[0:i])
+        return closure
+
+    def get_user_root(self, username, sections):
         """
+        This adds the ancestors of the sections that the user is in and sorts
+        them from the root down.
+        """
+        # The section records the user already has keyed by their path, so each
+        # section record is only built once per user.
+        section_records = {section.section_path: section for section in sections}
+
+        # Add all of the ancestor sections that the user isn't explicitly in.
+        for section_path in self.get_section_closure(section_records):
+            if section_path not in section_records:
+                section_records[section_path] = self.get_section_data(username, list(section_path))
+
+        # Sort the sections so that we can deterministically determine the order of merging configs
+        return tuple(section_records[section_path] for section_path in
+                     sorted(section_records, key = lambda x: (len(x), x)))
 
-        if user_dict is None:
-            user_dict = {}
+    def get_section_dict(self, section_dict):
+        """
+        Gets the section dictionary.
+        """
+        if type(section_dict) is dict:
+            return section_dict
+        else:
+            return {}
+
+    def get_user_section_index(self, index=None, path=None):
+        """
+        This maps each user to the sections they are explicitly listed in
+        without building any of the user records.
+        """
+        if index is None:
+            index = {}
         if path is None:
             path = []
 
-        section_key = self.get_section_dict_key(path)
-        section_data = safeget(self.section_dict, section_key)
+        section_data = safeget(self.section_dict, self.get_section_dict_key(path))
 
         if type(section_data.get("users")) is dict:
-            for user, user_data in section_data.get("users", {}).items():
-                if user not in user_dict:
-
-                    user_dict[user] = self.create_user_dict(user, path=path)
-
-                else:
-                    user_section_data = self.get_section_data(user, path)
-                    user_dict[user]["sections"].append(user_section_data)
-                    if len(user_dict[user]["root"]) > len(path):
-                        user_dict[user]["root"] = path
-
-                if type(user_data) is dict:
-                    # This makes it so that if you are set as an admin anywhere, you
-                    # are always an admin.
-                    user_dict[user]["admin"] = max(user_dict[user]["admin"],
-                                                user_data.get("admin", False))
-
-        # Now we recurse through the sections adding sections as we find them.
-        # Since a dict is mutable, we don't have to pass it back and forth.
-        # It is updated in place.
+            for user in section_data.get("users", {}):
+                index.setdefault(user, []).append(path)
+
         if type(section_data.get("sections")) is dict:
-            for section, section_data in section_data.get("sections", {}).items():
-                self.get_users_from_sections(user_dict = user_dict, path = path + [section])
+            for section in section_data.get("sections", {}):
+                self.get_user_section_index(index = index, path = path + [section])
 
-        return user_dict
+        return index
 
-    def get_user_root(self, username, user_data):
-        full_section_list = []
-        # Add all sublists to the section list
-        section_list = []
-        for section in user_data.get("sections", []):
-            section_path = section.get('section_path')
-            section_list.append(section_path)
+    def get_section_paths(self, section_data=None, path=(), paths=None):
+        """
+        This lists the paths of all sections as tuples.
+        """
+        if paths is None:
+            paths = []
+            section_data = self.section_dict
 
-        for section_path in section_list:
-            full_section_list = full_section_list + [section_path[0:i] for i in range(len(section_path) + 1)]
-        # Make the sublists unique
-        unique_section_list = [list(x) for x in set(tuple(x) for x in full_section_list)]
+        paths.append(path)
+        if type(section_data) is dict and type(section_data.get("sections")) is dict:
+            for section, subsection_data in section_data.get("sections", {}).items():
+                self.get_section_paths(subsection_data, path + (section,), paths)
 
-        for section_path in unique_section_list:
-            if section_path not in section_list:
-                user_data['sections'].append(self.get_section_data(username, section_path))
+        return paths
 
-        # Sort the sublists so that we can deterministically determine the order of merging configs
-        user_data["sections"].sort(key = lambda x: (len(x['section_path']), x["section_path"]))
+    def get_section_digests(self, section_data=None, path=(), digests=None):
+        """
+        This hashes the contents of every section (not including its
+        subsections) keyed by the section path as a tuple. Comparing these
+        tells us which sections changed between two versions of the file.
+        """
+        if digests is None:
+            digests = {}
+            section_data = self.section_dict
+
+        self.section_objects[path] = section_data
+        previous = self.previous_configurator
+        if previous is not None and previous.section_objects.get(path) is section_data:
+            # The section wasn't parsed again (see UserDataLoader), so it can't have changed.
+            digests[path] = previous.section_digests[path]
+        else:
+            if type(section_data) is dict:
+                contents = {key: value for key, value in section_data.items() if key != "sections"}
+            else:
+                contents = section_data
+            digests[path] = hashlib.sha256(repr(contents).encode('utf-8')).hexdigest()
 
-        user_data["root"] = []
+        if type(section_data) is dict and type(section_data.get("sections")) is dict:
+            for section, subsection_data in section_data.get("sections", {}).items():
+                self.get_section_digests(subsection_data, path + (section,), digests)
 
-        return user_data
+        return digests
 
-    def get_section_dict(self, section_dict):
+    def get_changed_users(self, previous, index):
         """
-        Gets the section dictionary.
+        This finds the users whose records could differ from the previous
+        configurator. A user's record only depends on the sections they are in
+        and the ancestors of those sections, so a user is changed if any of
+        those sections changed in either version.
         """
-        if type(section_dict) is dict:
-            return section_dict
-        else:
-            return {}
+        changed_sections = set(self.section_digests.keys() ^ previous.section_digests.keys())
+        for path, digest in self.section_digests.items():
+            if previous.section_digests.get(path, digest) != digest:
+                changed_sections.add(path)
+
+        changed_users = set()
+        for user, section_paths in index.items():
+            if user not in previous.user_dict:
+                changed_users.add(user)
+            elif not changed_sections.isdisjoint(self.get_section_closure(section_paths)):
+                changed_users.add(user)
+            elif any(section.section_path in changed_sections for section in previous.user_dict[user].sections):
+                # This catches sections the user was in that have been removed.
+                changed_users.add(user)
+
+        self.log.info("%i sections and %i users changed since the last load." % (len(changed_sections), len(changed_users)))
+        return changed_users
+
+    def create_user_record(self, username, section_paths):
+        """
+        This creates the full record for a user, which includes the sections the
+        user is in, the groups that they are in, and the relevant configuration
+        parameters, from the sections the user is explicitly listed in.
+        """
+        admin = False
+        sections = []
+        for path in section_paths:
+            sections.append(self.get_section_data(username, path))
+
+            section_user_data = safeget(self.section_dict, self.get_section_dict_key(path, ['users', username]))
+            if type(section_user_data) is dict:
+                # This makes it so that if you are set as an admin anywhere, you
+                # are always an admin.
+                admin = max(admin, section_user_data.get("admin", False))
+
+        # Now we get the paths from root to each section. Once we sort these, we
+        # will be able to get the root.
+        return UserRecord(admin, self.get_user_root(username, sections), self.get_custom_data())
+
+    def build_user_dict(self, index, usernames=None):
+        """
+        Builds the records for all users in the index, or only for the given usernames.
+        """
+        return {user: self.create_user_record(user, section_paths)
+                for user, section_paths in index.items()
+                if usernames is None or user in usernames}
 
     def get_user_dict(self):
         """
         Gets the user dictionary.
         """
         self.log.info("Getting the user_dict.")
-        # Get the user_dict with all explicitly set sections
-        user_dict = self.get_users_from_sections()
+        index = self.get_user_section_index()
+        # Usernames are repeated in every section the user is in, so only keep one copy.
+        index = {intern(user): section_paths for user, section_paths in index.items()}
 
-        # Now we get the paths from root to each section. Once we sort these, we
-        # will be able to get the root.
-        for user, user_data in user_dict.items():
-            user_dict[user] = self.get_user_root(user, user_data)
+        if self.lazy_user_dict:
+            # Everything is built on demand, so there is nothing to reuse.
+            self.rebuilt_users = set()
+            return LazyUserDict(index, self.create_user_record, max_size=self.user_cache_size)
+
+        if self.user_dict_loader is not None and self.cache_key is not None:
+            try:
+                user_dict = self.user_dict_loader(self.cache_key)
+            except Exception as e:
+                self.log.warning("Failed to load the stored user records. Building them instead: %s" % e)
+                user_dict = None
+            if user_dict is not None:
+                self.log.info("Loaded %i stored user records." % len(user_dict))
+                self.loaded_from_cache = True
+                self.rebuilt_users = set(user_dict)
+                return user_dict
+
+        previous = self.previous_configurator
+        if previous is None or isinstance(previous.user_dict, LazyUserDict):
+            user_dict = self.build_user_dict(index)
+            self.rebuilt_users = set(user_dict)
+            return user_dict
 
-        return user_dict
+        self.rebuilt_users = self.get_changed_users(previous, index)
+        rebuilt = self.build_user_dict(index, usernames=self.rebuilt_users)
+
+        # Keep the users in the same order as a full build.
+        return {user: rebuilt[user] if user in self.rebuilt_users else previous.user_dict[user]
+                for user in index}
 
 
 
@@ -332,12 +848,35 @@ class NFSUserConfigurator(UserConfigurator):
         """
     ).tag(config=True)
 
+    max_folder_workers = Integer(
+        default_value=16,
+        help="""
+        The number of threads used to create the section and group folders at startup.
+        """
+    ).tag(config=True)
+
+    @observe('user_section_base_folder')
+    def _user_section_base_folder_changed(self, change):
+        self.group_paths = {}
+        self.admin_volume_mount = None
+
     def __init__(self, 
                  section_dict, 
                  root_path = None, 
                  enable_custom_allowed = None,
+                 previous_configurator = None,
+                 source_hash = None,
+                 user_dict_loader = None,
                  **kwargs):
-        super().__init__(section_dict, root_path, enable_custom_allowed, **kwargs)
+        # The paths of every group keyed by section path and group name. They
+        # are built the first time they are used, which is while the records
+        # are built, and then shared by every member.
+        self.group_paths = {}
+        self.admin_volume_mount = None
+        # The folder with the home folders keyed by the user's root.
+        self.users_folders = {}
+        super().__init__(section_dict, root_path, enable_custom_allowed, previous_configurator,
+                         source_hash, user_dict_loader, **kwargs)
         self.log.info("Initializing the NFSUserConfigurator")
 
         if root_path is not None:
@@ -360,36 +899,99 @@ class NFSUserConfigurator(UserConfigurator):
     def create_base_folders(self, section_dict, root_path):
         """
         Create all folders for all sections and the sub folders for groups.
-        This recurses so it needs the section_dict given explicitly.
+        The folders are collected first and then created in a thread pool.
         """
+        self.create_folders(self.get_base_folders(section_dict, root_path))
+        return
+
+    def get_base_folders(self, section_dict, root_path, folders=None):
+        """
+        List all folders for all sections and the sub folders for groups with
+        parents before their children. This recurses so it needs the
+        section_dict given explicitly.
+        """
+        if folders is None:
+            folders = []
 
-        create_directory(root_path)
+        folders.append(root_path)
 
-        # Create groups folder
+        # Add groups folder
         if type(section_dict.get("groups")) is dict:
             if len(section_dict.get("groups")) > 0:
-                create_directory(root_path.joinpath("groups/"))
-                self.create_group_folders(section_dict, root_path.joinpath("groups/"))
+                folders.append(root_path.joinpath("groups/"))
+                self.get_group_folders(section_dict, root_path.joinpath("groups/"), folders)
 
-        # Create sections folder and recurse
+        # Add sections folder and recurse
         if type(section_dict.get("sections")) is dict:
             if len(section_dict.get("sections")) > 0:
-                create_directory(root_path.joinpath("sections/"))
+                folders.append(root_path.joinpath("sections/"))
             for subsection, section_data in section_dict.get("sections", {}).items():
-                self.create_base_folders(section_data, root_path.joinpath(Path("sections/" + subsection)))
-        return
+                self.get_base_folders(section_data, root_path.joinpath(Path("sections/" + subsection)), folders)
+        return folders
 
-    def create_group_folders(self, section_dict, root_path):
+    def get_group_folders(self, section_dict, root_path, folders):
         """
-        Create all group folders in the section.
+        List all group folders in the section.
         """
         
         if type(section_dict.get("groups")) is dict:
             for group, group_data in section_dict.get("groups", {}).items():
                 if type(group_data) is dict:
-                    create_directory(root_path.joinpath(group))
+                    folders.append(root_path.joinpath(group))
+        return folders
+
+    def get_existing_folders(self, folders, executor):
+        """
+        Find which of the folders already exist with the right permissions.
+        This lists each parent folder once instead of checking every folder
+        on its own.
+        """
+        wanted = set(folders)
+        parents = {folder.parent for folder in folders}
+
+        def scan(parent):
+            existing = set()
+            try:
+                with os.scandir(parent) as entries:
+                    for entry in entries:
+                        folder = parent.joinpath(entry.name)
+                        if folder in wanted and entry.is_dir() and stat.S_IMODE(entry.stat().st_mode) == FOLDER_MODE:
+                            existing.add(folder)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            return existing
+
+        return set().union(*executor.map(scan, parents))
+
+    def create_folders(self, folders):
+        """
+        Create the folders on a thread pool. Folders are created one depth at a
+        time so that parents always exist before their children, and folders
+        that already exist are skipped.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_folder_workers) as executor:
+            existing = self.get_existing_folders(folders, executor)
+            self.log.info("%i of %i folders already exist." % (len(existing), len(folders)))
+
+            levels = {}
+            for folder in folders:
+                if folder not in existing:
+                    levels.setdefault(len(folder.parts), []).append(folder)
+
+            for depth in sorted(levels):
+                # Consume the results so that any errors are raised here.
+                list(executor.map(create_directory, levels[depth]))
         return
 
+    def get_cache_key(self, source_hash):
+        """
+        The volume mounts in the records depend on the user section base folder too.
+        """
+        if source_hash is None:
+            return None
+        key = [super().get_cache_key(source_hash), self.user_section_base_folder]
+        return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
     def create_home_folder(self, username):
         """
         This function will set up the home folders for the user.
@@ -402,15 +1004,7 @@ class NFSUserConfigurator(UserConfigurator):
         escaped_username = get_escaped_string(username)
         self.log.debug("Creating home directory for user %r with escaped username of %r" % (username, escaped_username))
 
-        # If you don't have a valid authname, no reason to make your folders.
-        if user_data.get('authName') == 'null_authName_invalid':
-            return
-        root = user_data.get("root", [])
-        # username = user_data.get("username", user)
-        if len(root) > 0:
-            users_folder = self.root_path.joinpath("sections/" + "/sections/".join(root) + "/users/")
-        else:
-            users_folder = self.root_path.joinpath("users/")
+        users_folder = self.get_users_folder(user_data.root)
         # This creates the user folder when we first see someone with that root
         create_directory(users_folder)
         user_folder = users_folder.joinpath(escaped_username + "/")
@@ -420,54 +1014,165 @@ class NFSUserConfigurator(UserConfigurator):
         return
 
 
+    def get_users_folder(self, root):
+        """
+        Get the folder that the home folders of users with this root are in.
+        """
+        users_folder = self.users_folders.get(root)
+        if users_folder is None:
+            if len(root) > 0:
+                users_folder = self.root_path.joinpath("sections/" + "/sections/".join(root) + "/users/")
+            else:
+                users_folder = self.root_path.joinpath("users/")
+            self.users_folders[root] = users_folder
+        return users_folder
+
+    def get_group_paths(self, section_path, group):
+        """
+        Get the paths of a group folder, building them the first time.
+        """
+        key = (section_path, group.group_name)
+        group_paths = self.group_paths.get(key)
+        if group_paths is None:
+            sub_path = '/'.join(intersperse(list(section_path), 'sections', prepend_if_nonzero=True) + ['groups', group.group_name])
+            mount_path = self.user_section_base_folder + "/" + sub_path
+            group_paths = GroupPaths(mount_path,
+                                     sub_path,
+                                     Path(self.user_section_base_folder).joinpath(sub_path),
+                                     VolumeMount(mount_path, sub_path, "home", bool(group.read_only)))
+            self.group_paths[key] = group_paths
+        return group_paths
+
+    def get_admin_volume_mount(self):
+        """
+        Get the volume mount that gives admins the whole base folder.
+        """
+        if self.admin_volume_mount is None:
+            self.admin_volume_mount = VolumeMount(self.user_section_base_folder, None, "home", False)
+        return self.admin_volume_mount
+
+    def get_home_folder_fingerprint(self, username):
+        """
+        This returns a hash of everything that create_home_folder uses to build
+        the folders for the user. If the hash hasn't changed, the folders don't
+        need to be created again.
+        """
+        user_data = self.get_user_data(username)
+        if user_data is None:
+            return None
+
+        sections = [[list(section.section_path), [group.group_name for group in section.groups]]
+                    for section in user_data.sections]
+        key = [str(self.root_path),
+               self.user_section_base_folder,
+               get_escaped_string(username),
+               list(user_data.root),
+               sections]
+
+        return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
     def symlink_group_folders(self, user_folder, user_data):
         """
         This creates symlinks pointing to the right place for group folders.
+        Each folder in the user's home folder is listed once, and only the
+        folders and links that are missing are created.
         """
-        root = user_data.get("root", [])
-        for section in user_data.get('sections', []):
-            for group in section.get('groups', []):
-                section_path = section.get('section_path')
-
-                sections = []
-                for section_name in section_path[len(root):]:
-                    sections = sections + [section_name]
-                    create_directory(Path(user_folder).joinpath("/".join(sections)))
-                
-                src = Path(user_folder).joinpath("/".join(section_path)).joinpath(group["group_name"])
-                dest = Path(self.user_section_base_folder).joinpath("/".join(intersperse(section_path, 'sections', prepend_if_nonzero=True) 
-                                                                             + ["groups", group['group_name']]))
-
-                # This handles a pre-existing symlink. Note that I'm assuming the
-                # destination is absolute, so I have to know where the mount point
-                # is going to be.
-                counter = 0
-                if os.path.lexists(src) and (src.resolve() == Path(dest).resolve()):
-                    continue
-                elif os.path.lexists(src) and (src.resolve() != Path(dest).resolve()):
-                    new_src=src
-                    while os.path.lexists(new_src) and (new_src.resolve() != Path(dest).resolve()):
-                        counter = counter + 1
-                        new_src = src.parent.joinpath(src.name + " (" + str(counter) + ")")
-                    if new_src.resolve() == Path(dest).resolve():
-                        continue
-                    src = new_src
-
-                src.symlink_to(dest, target_is_directory=True)
+        user_folder = Path(user_folder)
+        root = user_data.root
+
+        # The links wanted in each folder of the home folder, keyed by the
+        # folder's path below the user folder.
+        links = {}
+        for section in user_data.sections:
+            if section.groups:
+                section_links = links.setdefault(tuple(section.section_path[len(root):]), {})
+                for group in section.groups:
+                    section_links[group.group_name] = self.get_group_paths(section.section_path, group).target
+
+        folders = set()
+        for folder in links:
+            folders.update(folder[:i] for i in range(1, len(folder) + 1))
+
+        listings = {}
+        def get_listing(folder):
+            if folder not in listings:
+                listings[folder] = self.list_folder(user_folder.joinpath(*folder))
+            return listings[folder]
+
+        # Parents come before their children, so each parent is listed before
+        # its children are checked.
+        for folder in sorted(folders, key=len):
+            entry = get_listing(folder[:-1]).get(folder[-1])
+            if entry is None or not entry.is_dir() or stat.S_IMODE(entry.stat().st_mode) != FOLDER_MODE:
+                create_directory(user_folder.joinpath(*folder))
+                # It was empty or isn't a folder we made, so don't trust a listing of it.
+                listings.pop(folder, None)
+
+        for folder, folder_links in links.items():
+            self.reconcile_links(user_folder.joinpath(*folder), get_listing(folder), folder_links)
         return
 
+    def list_folder(self, folder):
+        """
+        List a folder as a dictionary of the directory entries by name.
+        """
+        try:
+            with FILESYSTEM_OPERATION_DURATION_SECONDS.labels(operation='scandir').time():
+                with os.scandir(folder) as entries:
+                    return {entry.name: entry for entry in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            return {}
 
-    def get_user_dict(self):
-        self.user_dict = super().get_user_dict()
-        for _, user_data in self.user_dict.items():
-            self.get_extra_volume_mounts(user_data)
-
-        return self.user_dict
+    def reconcile_links(self, folder, entries, links):
+        """
+        Create the links from name to destination that are missing from the
+        folder. When something else already has the name, the link is named
+        "<name> (1)", "<name> (2)" and so on instead, like before.
+        """
+        for name, dest in links.items():
+            counter = 0
+            link_name = name
+            while link_name in entries and not self.is_link_to(entries[link_name], dest):
+                counter = counter + 1
+                link_name = name + " (" + str(counter) + ")"
+
+            if link_name not in entries:
+                with FILESYSTEM_OPERATION_DURATION_SECONDS.labels(operation='symlink').time():
+                    folder.joinpath(link_name).symlink_to(dest, target_is_directory=True)
+
+    def is_link_to(self, entry, dest):
+        """
+        Whether or not the directory entry is a symlink to dest.
+        """
+        if not entry.is_symlink():
+            return False
+        try:
+            with FILESYSTEM_OPERATION_DURATION_SECONDS.labels(operation='readlink').time():
+                target = os.readlink(entry.path)
+        except OSError:
+            return False
+        if target == str(dest):
+            return True
+        # The link may point to the same place by another path, which is rare
+        # enough that it is fine to resolve both.
+        return Path(entry.path).resolve() == dest.resolve()
+
+
+    def create_user_record(self, username, section_paths):
+        """
+        Creates the user record with the volume mounts already added. Records
+        are shared between requests, so they must not be modified.
+        """
+        return self.get_extra_volume_mounts(super().create_user_record(username, section_paths))
 
     def get_user_data(self, username):
         """
         This returns the user data if it exists. If not, it initializes it to default.
+        Known users get the record precomputed by get_user_dict.
         """
+        if username in self.user_dict:
+            return self.user_dict[username]
+
         user_data = super().get_user_data(username)
         if user_data is not None:
             user_data = self.get_extra_volume_mounts(user_data)
@@ -477,41 +1182,17 @@ class NFSUserConfigurator(UserConfigurator):
 
     def get_extra_volume_mounts(self, user_data):
         """
-        This gets the extra volume mounts and appends them to the last user_config so they cannot be overridden.
-        """
-
-        last_section = user_data.get('sections', [])[-1]
-
-        extra_volume_mounts = []
-        if not user_data.get('admin', False):
-            for section in user_data.get('sections', []):
-                for group in section.get('groups', {}):
-                    volume_name = "home"
-                    if group.get('readOnly', False) and not user_data.get('admin', False):
-                        read_only = True
-                    else:
-                        read_only = False
-                    volume_mount = {
-                        'mountPath': self.user_section_base_folder + "/"
-                                        + '/'.join(intersperse(section['section_path'], 'sections', prepend_if_nonzero=True) + ['groups', group['group_name']]),
-                        'subPath': '/'.join(intersperse(section['section_path'], 'sections', prepend_if_nonzero=True) + ['groups', group['group_name']]),
-                        'name': volume_name,
-                        'readOnly': read_only
-                    }
-                    extra_volume_mounts.append(volume_mount)
-        elif user_data.get('admin', False):
+        This gets the extra volume mounts, which are appended to the last user_config so they cannot be overridden.
+        A new user record is returned and the one passed in is left untouched. The
+        volume mounts are shared by all of the members of each group.
+        """
+        if user_data.admin:
             # This is so that the admin user has access to all of the files from the mount point.
-            volume_name = "home"
-            read_only = False
-            volume_mount = {
-                'mountPath': self.user_section_base_folder,
-                'name': volume_name,
-                'readOnly': read_only
-            }
-            extra_volume_mounts.append(volume_mount)
-
-        last_section['user_config']['configAppend']['volume_mounts'] = merge(last_section['user_config']['configAppend'].get('volume_mounts', None), extra_volume_mounts, append=True)
-        return user_data
+            return user_data.with_volume_mounts((self.get_admin_volume_mount(),))
+
+        return user_data.with_volume_mounts(tuple(self.get_group_paths(section.section_path, group).volume_mount
+                                                  for section in user_data.sections
+                                                  for group in section.groups))
 
 
 
@@ -534,7 +1215,7 @@ def main():
     print(configurator.get_user_data("new_user"))
 
     with open(Path(__file__).parent.parent.absolute().joinpath((Path('test_output.yaml'))), 'w') as f:
-        f.write(yaml.dump(user_dict, default_flow_style=False))
+        f.write(yaml.dump({user: user_data.to_dict() for user, user_data in user_dict.items()}, default_flow_style=False))
 
 if __name__=="__main__":
     main()
\ No newline at end of file
@@ -16,4 +16,39 @@ def url_path_join(*pieces):
     if result == '//':
         result = '/'
 
-    return result
\ No newline at end of file
+    return result
+
+def get_json_encoder(library='json', log=None):
+    """
+    Returns a function that encodes an object to utf-8 JSON bytes. The faster
+    `orjson` and `ujson` libraries are used if requested and installed.
+    Otherwise, this falls back to the standard library.
+    """
+    if library == 'orjson':
+        try:
+            import orjson
+            return orjson.dumps
+        except ImportError:
+            if log is not None:
+                log.warning("orjson is not installed. Falling back to json.")
+    elif library == 'ujson':
+        try:
+            import ujson
+            return lambda data: ujson.dumps(data, ensure_ascii=False).encode('utf-8')
+        except ImportError:
+            if log is not None:
+                log.warning("ujson is not installed. Falling back to json.")
+    elif library != 'json' and log is not None:
+        log.warning("Unknown json library %r. Falling back to json." % library)
+
+    import json
+    return lambda data: json.dumps(data).encode('utf-8')
+
+def load_yaml(data):
+    """
+    Parse YAML with the C loader from libyaml when PyYAML was built with it,
+    which is many times faster than the pure Python loader on large files.
+    """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(data, Loader=loader)
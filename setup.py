@@ -56,7 +56,8 @@ setup_args = dict(
     python_requires     = ">=3.5",
     entry_points={
         'console_scripts':[
-            'userdatahub = UserDataHub.app:main'
+            'userdatahub = UserDataHub.app:main',
+            'userdatahub-benchmark = UserDataHub.benchmark.app:main'
         ]
     },
     classifiers         = [
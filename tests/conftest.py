@@ -0,0 +1,86 @@
+import asyncio
+import copy
+import logging
+from pathlib import Path
+
+import pytest
+import yaml
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from traitlets.config import Config
+
+from UserDataHub.app import UserDataHub
+from UserDataHub.users import NFSUserConfigurator
+
+TEST_YAML = Path(__file__).parent.joinpath('test.yaml')
+
+
+@pytest.fixture
+def section_dict():
+    """
+    A fresh copy of the test roster, so that tests can edit it.
+    """
+    with open(TEST_YAML) as f:
+        return yaml.safe_load(f)['class']
+
+
+@pytest.fixture
+def make_configurator(tmp_path):
+    """
+    Build NFSUserConfigurators that create their folders in a temporary folder.
+    """
+    root = tmp_path.joinpath('root')
+    root.mkdir()
+
+    def make(section_dict, **kwargs):
+        kwargs.setdefault('log', logging.getLogger('test'))
+        return NFSUserConfigurator(copy.deepcopy(section_dict),
+                                   root_path=str(root),
+                                   user_section_base_folder=str(root),
+                                   **kwargs)
+    return make
+
+
+@pytest.fixture
+def hub(tmp_path, section_dict):
+    """
+    A UserDataHub serving the test roster, with its database, secret and
+    folders in a temporary folder.
+    """
+    root = tmp_path.joinpath('root')
+    root.mkdir(exist_ok=True)
+    user_data_file = tmp_path.joinpath('user_data.yaml')
+    with open(user_data_file, 'w') as f:
+        yaml.safe_dump(section_dict, f)
+
+    config = Config()
+    config.UserDataHub.user_data_file = str(user_data_file)
+    config.UserDataHub.db_url = 'sqlite:///%s' % tmp_path.joinpath('userdatahub.sqlite')
+    config.UserDataHub.cookie_secret_file = str(tmp_path.joinpath('cookie_secret'))
+    config.NFSUserConfigurator.root_path = str(root)
+    config.NFSUserConfigurator.user_section_base_folder = str(root)
+    hub = UserDataHub(config=config)
+    hub.initialize(['--log_level=WARN'])
+    return hub
+
+
+@pytest.fixture
+def fetch(hub):
+    """
+    Make a request to the hub and return the response, whatever its code.
+    """
+    def fetch(path, **kwargs):
+        async def go():
+            sockets = bind_sockets(0, '127.0.0.1')
+            port = sockets[0].getsockname()[1]
+            server = HTTPServer(hub.tornado_app)
+            server.add_sockets(sockets)
+            client = AsyncHTTPClient(force_instance=True)
+            try:
+                return await client.fetch('http://127.0.0.1:%i%s' % (port, path), raise_error=False, **kwargs)
+            finally:
+                client.close()
+                server.stop()
+        return asyncio.run(go())
+    return fetch
@@ -0,0 +1,68 @@
+"""
+The batch endpoint must answer every user exactly as /get-user would, and
+refuse requests that aren't signed or are too large.
+"""
+import json
+from urllib.parse import urlencode
+
+from tornado.web import create_signed_value, decode_signed_value
+
+
+def sign(hub, name, value):
+    return create_signed_value(hub.cookie_secret, name, value)
+
+
+def post_batch(hub, fetch, usernames):
+    body = sign(hub, 'user_batch', json.dumps(usernames))
+    return fetch('/get-user-batch', method='POST', body=body)
+
+
+def read_lines(response):
+    return [json.loads(line) for line in response.body.decode('utf-8').splitlines()]
+
+
+def test_batch_matches_get_user(hub, fetch):
+    response = post_batch(hub, fetch, ['alice', 'bob', 'erin'])
+    assert response.code == 200
+
+    lines = read_lines(response)
+    assert sorted(line['user'] for line in lines) == ['alice', 'bob', 'erin']
+    for line in lines:
+        single = fetch('/get-user?' + urlencode({'user': sign(hub, 'user_data', line['user'])}))
+        assert single.code == 200
+        assert decode_signed_value(hub.cookie_secret, 'user_data', line['data']) == \
+            decode_signed_value(hub.cookie_secret, 'user_data', single.body)
+
+
+def test_batch_unknown_users_are_forbidden(hub, fetch):
+    lines = read_lines(post_batch(hub, fetch, ['alice', 'nobody']))
+
+    assert {'user': 'nobody', 'error': 403} in lines
+    assert [line['user'] for line in lines if 'data' in line] == ['alice']
+
+
+def test_batch_answers_duplicates_once(hub, fetch):
+    lines = read_lines(post_batch(hub, fetch, ['bob', 'bob', 'nobody', 'nobody']))
+
+    assert sorted(line['user'] for line in lines) == ['bob', 'nobody']
+
+
+def test_batch_bad_signature(hub, fetch):
+    response = fetch('/get-user-batch', method='POST', body=json.dumps(['alice']))
+    assert response.code == 400
+
+    body = create_signed_value(b'not the secret', 'user_batch', json.dumps(['alice']))
+    assert fetch('/get-user-batch', method='POST', body=body).code == 400
+
+
+def test_batch_bad_body(hub, fetch):
+    for value in ('alice', json.dumps('alice'), json.dumps({'user': 'alice'}), json.dumps([1, 2])):
+        body = sign(hub, 'user_batch', value)
+        assert fetch('/get-user-batch', method='POST', body=body).code == 400
+
+
+def test_batch_too_large(hub, fetch):
+    hub.tornado_app.settings['max_batch_size'] = 2
+
+    assert post_batch(hub, fetch, ['alice', 'bob', 'carol']).code == 400
+    assert post_batch(hub, fetch, ['alice', 'bob']).code == 200
@@ -0,0 +1,87 @@
+"""
+Listing the users, either all at once or one page at a time.
+"""
+import json
+from urllib.parse import urlencode
+
+from tornado.web import create_signed_value, decode_signed_value
+
+
+def get_users(hub, fetch, **arguments):
+    arguments['all'] = create_signed_value(hub.cookie_secret, 'all_user_data', 'all')
+    response = fetch('/get-all-users?' + urlencode(arguments))
+    if response.code != 200:
+        return response.code
+    return json.loads(decode_signed_value(hub.cookie_secret, 'all_user_data', response.body))
+
+
+def walk(hub, fetch, **arguments):
+    """
+    Follow the cursor through all of the pages.
+    """
+    pages = []
+    cursor = None
+    while True:
+        if cursor is not None:
+            arguments['cursor'] = cursor
+        page = get_users(hub, fetch, **arguments)
+        pages.append(list(page['users']))
+        cursor = page['next']
+        if cursor is None:
+            return pages
+
+
+def test_without_paging_lists_everybody(hub, fetch):
+    expected = {username: {'admin': record.admin} for username, record in hub.configurator.user_dict.items()}
+
+    data = get_users(hub, fetch)
+
+    assert data == expected
+    assert list(data) == list(expected)
+
+
+def test_walk_pages(hub, fetch):
+    pages = walk(hub, fetch, limit=4)
+
+    assert pages == [['alice', 'bob', 'carol', 'dave'], ['erin', 'root_admin']]
+
+
+def test_last_page_has_no_next(hub, fetch):
+    assert walk(hub, fetch, limit=6) == [['alice', 'bob', 'carol', 'dave', 'erin', 'root_admin']]
+    assert get_users(hub, fetch, cursor='erin') == {'users': {'root_admin': {'admin': True}}, 'next': None}
+    assert get_users(hub, fetch, cursor='root_admin') == {'users': {}, 'next': None}
+
+
+def test_limit_is_clamped(hub, fetch):
+    hub.tornado_app.settings['users_page_size'] = 2
+
+    assert walk(hub, fetch, limit=100) == [['alice', 'bob'], ['carol', 'dave'], ['erin', 'root_admin']]
+    assert walk(hub, fetch, cursor='') == [['alice', 'bob'], ['carol', 'dave'], ['erin', 'root_admin']]
+    assert walk(hub, fetch, limit=0)[0] == ['alice']
+    assert walk(hub, fetch, limit=-5)[0] == ['alice']
+
+
+def test_limit_must_be_a_number(hub, fetch):
+    assert get_users(hub, fetch, limit='ten') == 400
+
+
+def test_filter_by_section(hub, fetch):
+    # The users of a subsection are also in the sections above it.
+    assert walk(hub, fetch, limit=10, section='course1') == [['alice', 'bob', 'carol', 'dave']]
+    assert walk(hub, fetch, limit=10, section='course1/sec1') == [['alice', 'dave']]
+    assert walk(hub, fetch, limit=10, section='nowhere') == [[]]
+
+
+def test_filter_by_group(hub, fetch):
+    assert walk(hub, fetch, limit=10, group='g1') == [['alice', 'bob', 'erin']]
+    assert walk(hub, fetch, limit=10, group='g1', section='course2') == [['bob', 'erin']]
+    assert walk(hub, fetch, group='t1', limit=1) == [['alice'], ['dave']]
+
+
+def test_filter_by_admin(hub, fetch):
+    assert walk(hub, fetch, limit=10, admin='true') == [['root_admin']]
+    assert walk(hub, fetch, limit=10, admin='false') == [['alice', 'bob', 'carol', 'dave', 'erin']]
+
+
+def test_filters_without_paging(hub, fetch):
+    assert get_users(hub, fetch, admin='true') == {'root_admin': {'admin': True}}
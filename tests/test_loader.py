@@ -0,0 +1,164 @@
+"""
+UserDataLoader loads the same section_dict from a single file or from a
+directory of section files, and only parses the files that changed.
+"""
+import logging
+import os
+
+import yaml
+
+from UserDataHub.loader import UserDataLoader
+
+
+def make_loader(path, **kwargs):
+    kwargs.setdefault('log', logging.getLogger('test'))
+    return UserDataLoader(str(path), **kwargs)
+
+
+def write_yaml(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        yaml.safe_dump(data, f)
+    # Make sure that an edit is noticed even if it happens within the mtime resolution.
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+
+def split_sections(section_dict, directory):
+    """
+    Write a section_dict as a directory with one file per section, nesting
+    the sections that have subsections in their own directories.
+    """
+    write_yaml(directory.joinpath('_root.yaml'), {key: value for key, value in section_dict.items() if key != 'sections'})
+    for name, section in section_dict.get('sections', {}).items():
+        if section.get('sections'):
+            split_sections(section, directory.joinpath(name))
+        else:
+            write_yaml(directory.joinpath(name + '.yaml'), section)
+
+
+def test_single_file(tmp_path, section_dict):
+    path = tmp_path.joinpath('user_data.yaml')
+    write_yaml(path, section_dict)
+
+    loaded, source_hash = make_loader(path).load()
+
+    assert loaded == section_dict
+    assert source_hash
+
+
+def test_single_file_reload(tmp_path, section_dict):
+    path = tmp_path.joinpath('user_data.yaml')
+    write_yaml(path, section_dict)
+    loader = make_loader(path)
+    first, first_hash = loader.load()
+
+    assert loader.load() == (first, first_hash)
+    assert loader.load()[0] is first
+
+    section_dict['users']['zed'] = {}
+    write_yaml(path, section_dict)
+    second, second_hash = loader.load()
+
+    assert second == section_dict
+    assert second_hash != first_hash
+
+
+def test_directory_matches_single_file(tmp_path, section_dict):
+    directory = tmp_path.joinpath('user_data')
+    split_sections(section_dict, directory)
+
+    loaded, _ = make_loader(directory).load()
+
+    assert loaded == section_dict
+
+
+def test_directory_reload_only_replaces_changed_sections(tmp_path, section_dict):
+    directory = tmp_path.joinpath('user_data')
+    split_sections(section_dict, directory)
+    loader = make_loader(directory)
+    first, first_hash = loader.load()
+
+    unchanged, unchanged_hash = loader.load()
+    assert unchanged is first
+    assert unchanged_hash == first_hash
+
+    section_dict['sections']['course2']['users']['zed'] = {}
+    write_yaml(directory.joinpath('course2.yaml'), section_dict['sections']['course2'])
+    second, second_hash = loader.load()
+
+    assert second == section_dict
+    assert second_hash != first_hash
+    assert second['sections']['course2'] is not first['sections']['course2']
+    assert second['sections']['course1'] is first['sections']['course1']
+
+
+def test_directory_new_and_removed_files(tmp_path, section_dict):
+    directory = tmp_path.joinpath('user_data')
+    split_sections(section_dict, directory)
+    loader = make_loader(directory)
+    loader.load()
+    signature = loader.get_signature()
+
+    write_yaml(directory.joinpath('course3.yaml'), {'users': {'gina': {}}})
+    assert loader.get_signature() != signature
+    assert loader.load()[0]['sections']['course3'] == {'users': {'gina': {}}}
+
+    os.unlink(directory.joinpath('course3.yaml'))
+    assert loader.load()[0] == section_dict
+
+
+def test_directory_skips_hidden_and_other_files(tmp_path, section_dict):
+    directory = tmp_path.joinpath('user_data')
+    split_sections(section_dict, directory)
+    write_yaml(directory.joinpath('.hidden.yaml'), {'users': {'mallory': {}}})
+    directory.joinpath('README.txt').write_text('not a section')
+
+    assert make_loader(directory).load()[0] == section_dict
+
+
+def test_file_next_to_directory_holds_its_settings(tmp_path, caplog):
+    directory = tmp_path.joinpath('user_data')
+    write_yaml(directory.joinpath('course1.yaml'), {'users': {'alice': {}}})
+    write_yaml(directory.joinpath('course1', 'sec1.yaml'), {'users': {'bob': {}}})
+    loader = make_loader(directory)
+
+    assert loader.load()[0] == {'sections': {'course1': {'users': {'alice': {}},
+                                                         'sections': {'sec1': {'users': {'bob': {}}}}}}}
+
+    # The directory's own root file wins over the file next to it.
+    write_yaml(directory.joinpath('course1', '_root.yaml'), {'users': {'carol': {}}})
+    with caplog.at_level(logging.WARNING):
+        loaded, _ = loader.load()
+
+    assert loaded == {'sections': {'course1': {'users': {'carol': {}},
+                                               'sections': {'sec1': {'users': {'bob': {}}}}}}}
+    assert 'course1.yaml' in caplog.text
+
+
+def test_cache_is_used_by_a_new_loader(tmp_path, section_dict, monkeypatch):
+    path = tmp_path.joinpath('user_data.yaml')
+    cache_file = tmp_path.joinpath('cache.pickle')
+    write_yaml(path, section_dict)
+    make_loader(path, cache_file=str(cache_file)).load()
+    assert cache_file.exists()
+
+    def fail(data):
+        raise AssertionError("The file was parsed again.")
+    monkeypatch.setattr('UserDataHub.loader.load_yaml', fail)
+
+    assert make_loader(path, cache_file=str(cache_file)).load()[0] == section_dict
+
+
+def test_cache_writable_by_others_is_ignored(tmp_path, section_dict, monkeypatch):
+    path = tmp_path.joinpath('user_data.yaml')
+    cache_file = tmp_path.joinpath('cache.pickle')
+    write_yaml(path, section_dict)
+    make_loader(path, cache_file=str(cache_file)).load()
+    os.chmod(cache_file, 0o666)
+
+    def fail(f):
+        raise AssertionError("The cache was unpickled.")
+    monkeypatch.setattr('UserDataHub.loader.pickle.load', fail)
+
+    assert make_loader(path, cache_file=str(cache_file)).load()[0] == section_dict
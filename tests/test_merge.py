@@ -0,0 +1,102 @@
+"""
+merge() and merge_chain() decide what every user's config ends up as, so
+they are checked against the original quadratic merge on random configs as
+well as on the cases that matter in practice.
+"""
+import copy
+import random
+from collections.abc import Mapping
+
+import pytest
+
+from UserDataHub.users import merge, merge_chain
+
+
+def reference_merge(a, b, append=False):
+    """
+    The original merge, which modified a. It is only called on copies here.
+    """
+    merged = b
+    if append and not b:
+        merged = a
+    if isinstance(a, list) and isinstance(b, list):
+        merged = b.copy()
+        if append:
+            a.extend(x for x in b if x not in a)
+            merged = a
+    elif isinstance(a, str) and isinstance(b, str):
+        merged = a + b if append else b
+    elif isinstance(a, Mapping) and isinstance(b, Mapping):
+        merged = a.copy()
+        for key in b:
+            merged[key] = reference_merge(a[key], b[key], append) if key in a else b[key]
+    return merged
+
+
+def random_value(rng, depth=0):
+    choice = rng.random()
+    if depth > 3 or choice < 0.3:
+        return rng.choice([0, 1, True, False, None, 'a', 'b', '', 2.0])
+    if choice < 0.6:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {rng.choice('abcd'): random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))}
+
+
+def test_override():
+    assert merge({'image': 'base', 'cpu': 1}, {'cpu': 2}) == {'image': 'base', 'cpu': 2}
+    assert merge({'env': {'A': '1'}}, {'env': {'B': '2'}}) == {'env': {'A': '1', 'B': '2'}}
+    assert merge([1, 2], [3]) == [3]
+    assert merge('a', 'b') == 'b'
+
+
+def test_append():
+    assert merge([1, 2], [2, 3], append=True) == [1, 2, 3]
+    assert merge('a', 'b', append=True) == 'ab'
+    assert merge(True, False, append=True) is True
+    assert merge({'x': [1]}, {'x': [1, 2]}, append=True) == {'x': [1, 2]}
+
+
+def test_append_volume_mounts():
+    shared = {'name': 'shared', 'mountPath': '/shared'}
+    read_only = {'name': 'shared', 'mountPath': '/shared', 'readOnly': True}
+    group = {'name': 'home', 'mountPath': '/group', 'subPath': 'groups/g1'}
+
+    merged = merge([shared], [dict(shared), group, read_only], append=True)
+
+    # Equal mounts are only kept once, but ones that differ in any field are all kept.
+    assert merged == [shared, group, read_only]
+
+
+def test_merge_does_not_modify_inputs():
+    a = {'configAppend': {'volume_mounts': [{'name': 'a'}]}, 'list': [1]}
+    b = {'configAppend': {'volume_mounts': [{'name': 'b'}]}, 'list': [2]}
+    a_copy, b_copy = copy.deepcopy(a), copy.deepcopy(b)
+
+    merge(a, b, append=True)
+    merge_chain([a, b, a], append=True)
+
+    assert a == a_copy
+    assert b == b_copy
+
+
+def test_merge_chain_of_nothing():
+    assert merge_chain([]) is None
+
+
+@pytest.mark.parametrize('append', [False, True])
+def test_matches_reference(append):
+    rng = random.Random(1)
+    for _ in range(2000):
+        chain = [random_value(rng) for _ in range(rng.randint(1, 5))]
+
+        expected = copy.deepcopy(chain[0])
+        for value in copy.deepcopy(chain[1:]):
+            expected = reference_merge(expected, value, append)
+
+        folded = chain[0]
+        for value in chain[1:]:
+            folded = merge(folded, value, append)
+
+        # repr() also tells True apart from 1.
+        assert repr(folded) == repr(expected), chain
+        assert repr(merge_chain(chain, append)) == repr(expected), chain
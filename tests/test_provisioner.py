@@ -0,0 +1,74 @@
+"""
+The provisioner creates a user's home folder once per version of their
+folders, no matter how many logins ask for it at the same time.
+"""
+import asyncio
+import logging
+import threading
+
+import pytest
+
+from UserDataHub.provisioner import HomeFolderProvisioner
+
+
+@pytest.fixture
+def provisioner(section_dict, make_configurator):
+    provisioner = HomeFolderProvisioner(make_configurator(section_dict), log=logging.getLogger('test'))
+    yield provisioner
+    provisioner.shutdown(wait=True)
+
+
+def count_calls(configurator, started=None, release=None):
+    """
+    Replace create_home_folder with one that counts its calls per user and,
+    if given the events, waits to be released so that calls overlap.
+    """
+    calls = []
+    create_home_folder = configurator.create_home_folder
+
+    def counting_create_home_folder(username):
+        calls.append(username)
+        if started is not None:
+            started.set()
+            release.wait(5)
+        return create_home_folder(username)
+    configurator.create_home_folder = counting_create_home_folder
+    return calls
+
+
+def test_concurrent_logins_create_once(provisioner):
+    started = threading.Event()
+    release = threading.Event()
+    calls = count_calls(provisioner.configurator, started, release)
+
+    async def go():
+        logins = [asyncio.ensure_future(provisioner.provision('alice')) for _ in range(5)]
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        release.set()
+        await asyncio.gather(*logins)
+    asyncio.run(go())
+
+    assert calls == ['alice']
+
+
+def test_unchanged_fingerprint_skips(provisioner):
+    calls = count_calls(provisioner.configurator)
+
+    asyncio.run(provisioner.provision('alice'))
+    asyncio.run(provisioner.provision('alice'))
+
+    assert calls == ['alice']
+
+
+def test_changed_groups_create_again(provisioner, section_dict, make_configurator):
+    asyncio.run(provisioner.provision('bob'))
+    fingerprint = provisioner.configurator.get_home_folder_fingerprint('bob')
+
+    section_dict['sections']['course2']['groups']['g1']['members'].remove('bob')
+    provisioner.configurator = make_configurator(section_dict)
+    calls = count_calls(provisioner.configurator)
+    asyncio.run(provisioner.provision('bob'))
+
+    assert provisioner.configurator.get_home_folder_fingerprint('bob') != fingerprint
+    assert calls == ['bob']
+    assert provisioner.is_provisioned('bob', provisioner.configurator.get_home_folder_fingerprint('bob'))
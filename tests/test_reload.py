@@ -0,0 +1,97 @@
+"""
+Reloading with the previous configurator only rebuilds the users in the
+sections that changed, so it must always give the same records as building
+everything again.
+"""
+import pytest
+
+
+def to_dicts(configurator):
+    return {username: record.to_dict() for username, record in configurator.user_dict.items()}
+
+
+def edit_section_config(section_dict):
+    section_dict['sections']['course1']['configOverride'] = {'cpu': 4}
+
+def edit_subsection(section_dict):
+    section_dict['sections']['course1']['sections']['sec1']['users']['frank'] = {}
+
+def edit_root(section_dict):
+    section_dict['configOverride']['image'] = 'other'
+
+def edit_group_members(section_dict):
+    section_dict['sections']['course2']['groups']['g1']['members'].remove('bob')
+
+def edit_user_config(section_dict):
+    section_dict['sections']['course1']['users']['carol'] = {'configAppend': {'env': {'Y': '2'}}}
+
+def add_section(section_dict):
+    section_dict['sections']['course3'] = {'users': {'alice': {}, 'gina': {}}}
+
+def remove_section(section_dict):
+    del section_dict['sections']['course1']['sections']
+
+def remove_user(section_dict):
+    del section_dict['sections']['course2']['users']['erin']
+
+def make_admin(section_dict):
+    section_dict['sections']['course2']['users']['bob'] = {'admin': True}
+
+
+EDITS = [edit_section_config, edit_subsection, edit_root, edit_group_members, edit_user_config,
+         add_section, remove_section, remove_user, make_admin]
+
+
+@pytest.mark.parametrize('edit', EDITS, ids=[edit.__name__ for edit in EDITS])
+def test_reload_matches_full_rebuild(section_dict, make_configurator, edit):
+    previous = make_configurator(section_dict)
+    edit(section_dict)
+
+    reloaded = make_configurator(section_dict, previous_configurator=previous)
+    rebuilt = make_configurator(section_dict)
+
+    assert to_dicts(reloaded) == to_dicts(rebuilt)
+    assert list(reloaded.user_dict) == list(rebuilt.user_dict)
+    assert reloaded.encoded_user_dict == rebuilt.encoded_user_dict
+
+
+@pytest.mark.parametrize('edit', EDITS, ids=[edit.__name__ for edit in EDITS])
+def test_reload_keeps_unchanged_users(section_dict, make_configurator, edit):
+    previous = make_configurator(section_dict)
+    edit(section_dict)
+
+    reloaded = make_configurator(section_dict, previous_configurator=previous)
+
+    for username, record in reloaded.user_dict.items():
+        if username not in reloaded.rebuilt_users:
+            assert record is previous.user_dict[username]
+
+
+def test_reload_without_changes_rebuilds_nobody(section_dict, make_configurator):
+    previous = make_configurator(section_dict)
+    reloaded = make_configurator(section_dict, previous_configurator=previous)
+
+    assert reloaded.rebuilt_users == set()
+    assert to_dicts(reloaded) == to_dicts(previous)
+
+
+def test_reload_only_rebuilds_users_of_changed_section(section_dict, make_configurator):
+    previous = make_configurator(section_dict)
+    section_dict['sections']['course2']['configOverride'] = {'cpu': 8}
+
+    reloaded = make_configurator(section_dict, previous_configurator=previous)
+
+    assert reloaded.rebuilt_users == {'bob', 'erin'}
+
+
+def test_reload_after_lazy_matches_full_rebuild(section_dict, make_configurator):
+    previous = make_configurator(section_dict, lazy_user_dict=True)
+    edit_section_config(section_dict)
+
+    reloaded = make_configurator(section_dict, previous_configurator=previous)
+    rebuilt = make_configurator(section_dict)
+
+    assert previous.section_digests == {}
+    assert previous.section_paths == rebuilt.section_paths
+    assert previous.get_group_count() == rebuilt.get_group_count()
+    assert to_dicts(reloaded) == to_dicts(rebuilt)
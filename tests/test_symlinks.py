@@ -0,0 +1,102 @@
+"""
+The group folders are linked into every home folder. Reconciling the links
+only creates the ones that are missing, and works around anything else that
+already has a link's name the same way as always.
+"""
+import os
+
+import pytest
+
+
+@pytest.fixture
+def configurator(make_configurator):
+    return make_configurator({'users': {}})
+
+
+@pytest.fixture
+def targets(tmp_path):
+    targets = {}
+    for name in ('g1', 'g2'):
+        targets[name] = tmp_path.joinpath('groups', name)
+        targets[name].mkdir(parents=True)
+    return targets
+
+
+def reconcile(configurator, folder, links):
+    configurator.reconcile_links(folder, configurator.list_folder(folder), links)
+
+
+def read_links(folder):
+    return {entry.name: os.readlink(entry.path) for entry in os.scandir(folder) if entry.is_symlink()}
+
+
+def test_creates_missing_links(configurator, targets, tmp_path):
+    folder = tmp_path.joinpath('home')
+    folder.mkdir()
+
+    reconcile(configurator, folder, targets)
+
+    assert read_links(folder) == {name: str(target) for name, target in targets.items()}
+
+
+def test_keeps_existing_links(configurator, targets, tmp_path):
+    folder = tmp_path.joinpath('home')
+    folder.mkdir()
+    reconcile(configurator, folder, targets)
+    inode = os.lstat(folder.joinpath('g1')).st_ino
+
+    reconcile(configurator, folder, targets)
+
+    assert os.lstat(folder.joinpath('g1')).st_ino == inode
+    assert sorted(os.listdir(folder)) == ['g1', 'g2']
+
+
+def test_link_to_same_place_by_another_path(configurator, targets, tmp_path):
+    folder = tmp_path.joinpath('home')
+    folder.mkdir()
+    folder.joinpath('g1').symlink_to(os.path.join(str(targets['g1']), '..', 'g1'), target_is_directory=True)
+
+    reconcile(configurator, folder, {'g1': targets['g1']})
+
+    assert os.listdir(folder) == ['g1']
+
+
+def test_name_collisions_are_numbered(configurator, targets, tmp_path):
+    folder = tmp_path.joinpath('home')
+    folder.mkdir()
+    # A user's own folder, a file and a link elsewhere all take names.
+    folder.joinpath('g1').mkdir()
+    folder.joinpath('g1 (1)').write_text('notes')
+    folder.joinpath('g2').symlink_to(targets['g1'], target_is_directory=True)
+
+    reconcile(configurator, folder, targets)
+
+    assert read_links(folder) == {'g1 (2)': str(targets['g1']),
+                                  'g2': str(targets['g1']),
+                                  'g2 (1)': str(targets['g2'])}
+    assert folder.joinpath('g1').is_dir() and not folder.joinpath('g1').is_symlink()
+
+    # Running again finds the numbered links instead of adding more.
+    reconcile(configurator, folder, targets)
+    assert sorted(os.listdir(folder)) == ['g1', 'g1 (1)', 'g1 (2)', 'g2', 'g2 (1)']
+
+
+def test_home_folders_of_test_roster(section_dict, make_configurator):
+    configurator = make_configurator(section_dict)
+    base = configurator.user_section_base_folder
+
+    for username in configurator.user_dict:
+        configurator.create_home_folder(username)
+
+    bob = configurator.get_users_folder(configurator.user_dict['bob'].root).joinpath('bob')
+    assert read_links(bob.joinpath('course1')) == {
+        'all': base + '/sections/course1/groups/all',
+        'g1': base + '/sections/course1/groups/g1',
+        'g2': base + '/sections/course1/groups/g2',
+    }
+    assert read_links(bob.joinpath('course2')) == {'g1': base + '/sections/course2/groups/g1'}
+
+    before = {path: sorted(names) for path, _, names in os.walk(configurator.root_path)}
+    for username in configurator.user_dict:
+        configurator.create_home_folder(username)
+    assert {path: sorted(names) for path, _, names in os.walk(configurator.root_path)} == before